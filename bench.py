@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+'''Benchmarks of validators, flatten/deepen and widgets rendering
+
+    python bench.py                      # run all cases
+    python bench.py list_tuples deepen   # run selected cases
+    python bench.py --save base.json     # save results as baseline
+    python bench.py --compare base.json  # compare with saved baseline
+
+Every case runs in separate process, so peak memory is measured for the
+case only. Allocated bytes are bytes of objects, that one call builds and
+keeps alive in its result. Exit status is 1 if any case fails or is slower
+than baseline more than by `--threshold` percents.
+'''
+
+import gc
+import json
+import optparse
+import resource
+import sys
+import time
+import traceback
+from array import array
+from multiprocessing import Process, Queue
+
+from procrustes import validators as v
+from procrustes import forms, render
+
+
+CASES = []
+
+
+def case(func):
+    '''Register case, function returns callable to benchmark'''
+    CASES.append((func.__name__, func))
+    return func
+
+
+# Schemas
+def wide_dict_schema(width=100):
+    return v.Dict(dict(('field%i' % i, v.Integer(min=0) if i % 2 else
+                        v.String(max_length=20)) for i in xrange(width)))
+
+
+def wide_dict_data(width=100):
+    return dict(('field%i' % i, i if i % 2 else 'value %i' % i)
+                for i in xrange(width))
+
+
+def deep_schema(depth=30):
+    schema = v.String()
+    for i in xrange(depth):
+        schema = v.Dict({'name': v.String(), 'child': schema})
+    return schema
+
+
+def deep_data(depth=30):
+    data = 'leaf'
+    for i in xrange(depth):
+        data = {'name': 'level %i' % i, 'child': data}
+    return data
+
+
+LIST_TUPLES = v.List(v.Tuple(v.Integer(min=0), v.String(regex='[a-z0-9]+')))
+LIST_TUPLES_DATA = [(i, 'item%i' % i) for i in xrange(10000)]
+
+
+class Pet(forms.Declarative):
+    name = forms.String(field_name='Name')
+    species = forms.String(field_name='Species')
+    age = forms.Integer(field_name='Age', min=0)
+    field_name = 'Pet'
+
+
+class PetsForm(forms.Declarative):
+    name = forms.String(field_name='Your name')
+    age = forms.Integer(field_name='Age')
+    pets = forms.List(Pet)
+
+
+def pets_data(rows=300):
+    return {'name': 'owner', 'age': 30,
+            'pets': [{'name': 'pet%i' % i, 'species': 'cat', 'age': i % 20}
+                     for i in xrange(rows)]}
+
+
+def pets_flat(rows=300):
+    flat = {'form__name': 'owner', 'form__age': '30'}
+    for i in xrange(rows):
+        flat['form__pets__%i__name' % i] = 'pet%i' % i
+        flat['form__pets__%i__species' % i] = 'cat'
+        flat['form__pets__%i__age' % i] = str(i % 20)
+    return flat
+
+
+# Cases
+@case
+def integer():
+    schema = v.Integer(min=0, max=100)
+    return lambda: schema(42)
+
+
+@case
+def integer_plan():
+    plan = v.Integer(min=0, max=100).compile()
+    return lambda: plan(42)
+
+
+@case
+def string():
+    schema = v.String(max_length=20, regex='[a-z]+')
+    return lambda: schema('kuku')
+
+
+@case
+def string_plan():
+    plan = v.String(max_length=20, regex='[a-z]+').compile()
+    return lambda: plan('kuku')
+
+
+@case
+def wide_dict():
+    schema, data = wide_dict_schema(), wide_dict_data()
+    return lambda: schema(data)
+
+
+@case
+def wide_dict_plan():
+    plan, data = wide_dict_schema().compile(), wide_dict_data()
+    return lambda: plan(data)
+
+
+@case
+def deep_nesting():
+    schema, data = deep_schema(), deep_data()
+    return lambda: schema(data)
+
+
+@case
+def deep_nesting_plan():
+    plan, data = deep_schema().compile(), deep_data()
+    return lambda: plan(data)
+
+
+@case
+def list_tuples():
+    return lambda: LIST_TUPLES(LIST_TUPLES_DATA)
+
+
+@case
+def list_tuples_plan():
+    plan = LIST_TUPLES.compile()
+    return lambda: plan(LIST_TUPLES_DATA)
+
+
+NUMBERS = array('l', xrange(100000))
+
+
+@case
+def list_integers_plan():
+    plan = v.List(v.Integer(min=0, max=1000000)).compile()
+    numbers = list(NUMBERS)
+    return lambda: plan(numbers)
+
+
+@case
+def array_integers_plan():
+    plan = v.List(v.Integer(min=0, max=1000000)).compile()
+    return lambda: plan(NUMBERS)
+
+
+COUNTRIES = ['ru', 'us', 'de', 'fr', 'ua', 'pl', 'gb', 'es'] * 1250
+
+
+@case
+def list_strings():
+    schema = v.List(v.String(regex='[a-z]{2}'))
+    return lambda: schema(COUNTRIES)
+
+
+@case
+def list_strings_memo():
+    schema = v.List(v.String(regex='[a-z]{2}', memoize=256))
+    return lambda: schema(COUNTRIES)
+
+
+@case
+def list_strings_memo_plan():
+    plan = v.List(v.String(regex='[a-z]{2}', memoize=256)).compile()
+    return lambda: plan(COUNTRIES)
+
+
+@case
+def flatten_deepen():
+    schema = v.Dict({'name': v.String(), 'items': LIST_TUPLES})
+    validated = schema({'name': 'kuku', 'items': LIST_TUPLES_DATA[:1000]})
+    return lambda: schema.deepen(dict(validated.flatten()))
+
+
+@case
+def form_is_valid():
+    flat = pets_flat()
+    return lambda: PetsForm(flat, False).is_valid()
+
+
+@case
+def render_widgets():
+    form = PetsForm(pets_data())
+    return lambda: [widget.render() for widget in form.widgets()]
+
+
+@case
+def render_form():
+    form = PetsForm(pets_data())
+    renderer = render.Renderer(PetsForm)
+    return lambda: renderer.render(form)
+
+
+# Measuring
+def timeit(func, min_time=0.2, repeat=3):
+    '''Return best operations per second of `repeat` runs'''
+    loops = 1
+    while True:
+        start = time.time()
+        for i in xrange(loops):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2
+    best = elapsed
+    for i in xrange(repeat - 1):
+        start = time.time()
+        for i in xrange(loops):
+            func()
+        best = min(best, time.time() - start)
+    return loops / best
+
+
+def allocations(func):
+    '''Return bytes of objects, that one call allocates and keeps alive
+
+    Python 2 has no `tracemalloc`, so objects, that garbage collector tracks,
+    are compared before and after the call and new ones are sized by
+    `sys.getsizeof`. Strings and numbers inside results are not tracked,
+    untracked result itself is counted.
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        # old objects are kept alive, so their ids are not reused
+        before = gc.get_objects()
+        known = set(map(id, before))
+        known.update((id(before), id(known)))
+        result = func()
+        size = sum(sys.getsizeof(obj) for obj in gc.get_objects()
+                   if id(obj) not in known)
+        if not gc.is_tracked(result):
+            size += sys.getsizeof(result)
+        return size
+    finally:
+        gc.enable()
+
+
+def run_case(name, factory, options, queue):
+    try:
+        func = factory()
+        gc.collect()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        queue.put({'name': name,
+                   'ops': timeit(func, options.min_time, options.repeat),
+                   'allocated': allocations(func),
+                   'peak_kb': peak})
+    except Exception:
+        queue.put({'name': name, 'error': traceback.format_exc()})
+
+
+def run(names, options):
+    results = {}
+    for name, factory in CASES:
+        if names and name not in names:
+            continue
+        queue = Queue()
+        process = Process(target=run_case,
+                          args=(name, factory, options, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+    return results
+
+
+def report(results, baseline, threshold):
+    regressions = []
+    print '%-20s %14s %12s %10s %10s' % ('case', 'ops/sec', 'allocated',
+                                         'peak kB', 'change')
+    for name, factory in CASES:
+        if name not in results:
+            continue
+        result = results[name]
+        if 'error' in result:
+            print '%-20s failed\n%s' % (name, result['error'])
+            regressions.append(name)
+            continue
+        change = ''
+        if 'ops' in baseline.get(name, ()):
+            percent = (result['ops'] / baseline[name]['ops'] - 1) * 100
+            change = '%+.1f%%' % percent
+            if percent < -threshold:
+                regressions.append(name)
+                change += ' !'
+        allocated = result['allocated']
+        print '%-20s %14.1f %12s %10i %10s' % (
+            name, result['ops'], '-' if allocated is None else allocated,
+            result['peak_kb'], change)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [case ...]')
+    parser.add_option('--save', metavar='FILE',
+                      help='save results to baseline file')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare results with baseline file')
+    parser.add_option('--threshold', type='float', default=10.0,
+                      help='allowed slowdown in percents [%default]')
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='minimal time of one measure [%default]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='measures of every case [%default]')
+    options, names = parser.parse_args()
+    results = run(names, options)
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, options.threshold)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print 'Failed or slower than baseline:', ', '.join(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+# (c) Svarga project under terms of the new BSD license
+'''Budgets of validation
+
+Limits bound work, that one validation may do on hostile data:
+
+    >>> limits = budgets.Limits(max_depth=32, max_nodes=10000,
+    ...                         max_string_bytes=2 ** 20)
+    >>> result = schema.compile()(data, limits=limits)
+    >>> form = Form(data, limits=limits)
+    >>> schema = v.List(Record, limits=limits)
+
+Limits are set for a call, or for any schema by `limits` argument, limits of
+outermost validated schema apply. Values are counted as they are validated,
+so items of generators are not consumed after budget is exhausted, and
+validation stops at once: result fails with `errors.LimitExceeded` error.
+Strings are counted by UTF-8 bytes. Value of `Union` or `Tagged` is counted
+once, values of variants, that failed to validate it, are not counted.
+Validation without limits pays only for one check of `running`, or of
+`utils.instrumented` for validators.
+'''
+
+from threading import local, Lock
+from procrustes import utils
+from procrustes.errors import Error, LimitExceeded
+
+
+# number of active budgets in all threads
+running = 0
+lock = Lock()
+state = local()
+# value of union, that is counted already, see `Budget.attempt`
+NOTHING = object()
+
+
+def current():
+    '''Return budget of this thread, or None'''
+    return getattr(state, 'budget', None)
+
+
+def size_of(value):
+    if isinstance(value, unicode):
+        return len(value.encode('utf-8'))
+    return len(value)
+
+
+class Limits(object):
+    __slots__ = ('max_depth', 'max_nodes', 'max_string_bytes')
+
+    def __init__(self, max_depth=None, max_nodes=None, max_string_bytes=None):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_string_bytes = max_string_bytes
+
+    def __reduce__(self):
+        return Limits, (self.max_depth, self.max_nodes, self.max_string_bytes)
+
+    def __repr__(self):
+        return 'Limits(max_depth=%r, max_nodes=%r, max_string_bytes=%r)' % (
+            self.max_depth, self.max_nodes, self.max_string_bytes)
+
+
+class Budget(object):
+    '''Counters of one validation, active in its thread inside `with`
+    '''
+    __slots__ = ('limits', 'depth', 'nodes', 'string_bytes', 'counted')
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.depth = 0
+        self.nodes = 0
+        self.string_bytes = 0
+        self.counted = NOTHING
+
+    def __enter__(self):
+        global running
+        state.budget = self
+        with lock:
+            running += 1
+        utils.instrument(1)
+        return self
+
+    def __exit__(self, *exc_info):
+        global running
+        state.budget = None
+        with lock:
+            running -= 1
+        utils.instrument(-1)
+
+    def node(self, path=()):
+        self.nodes += 1
+        limit = self.limits.max_nodes
+        if limit is not None and self.nodes > limit:
+            raise LimitExceeded(Error('max_nodes',
+                                      'Must have at most %i values',
+                                      (limit,)), path)
+
+    def string(self, size, path=()):
+        self.string_bytes += size
+        limit = self.limits.max_string_bytes
+        if limit is not None and self.string_bytes > limit:
+            raise LimitExceeded(Error('max_string_bytes',
+                                      'Strings must have at most %i bytes',
+                                      (limit,)), path)
+
+    def count(self, raw, path=()):
+        '''Count raw value, unless it is value of union, counted already'''
+        if raw is self.counted:
+            self.counted = NOTHING
+            return
+        self.node(path)
+        if isinstance(raw, basestring):
+            self.string(size_of(raw), path)
+
+    def descend(self, path=()):
+        self.depth += 1
+        limit = self.limits.max_depth
+        if limit is not None and self.depth > limit:
+            raise LimitExceeded(Error('max_depth',
+                                      'Must be nested at most %i levels deep',
+                                      (limit,)), path)
+
+    def ascend(self):
+        self.depth -= 1
+
+    def attempt(self, raw):
+        '''Start validation of counted value of union by its variant, return
+        mark for `attempted`
+        '''
+        self.counted = raw
+        return self.nodes, self.string_bytes
+
+    def attempted(self, mark, failed):
+        '''Finish validation by variant, values of failed one are not
+        counted
+        '''
+        self.counted = NOTHING
+        if failed:
+            self.nodes, self.string_bytes = mark
+
+    def validate(self, instance, safe, nested):
+        '''Validate validator instance, `nested` for containers'''
+        self.count(instance.raw_data)
+        if not nested:
+            return instance.validate_raw(safe)
+        self.descend()
+        try:
+            return instance.validate_raw(safe)
+        finally:
+            self.ascend()
@@ -0,0 +1,271 @@
+# (c) Svarga project under terms of the new BSD license
+'''Code generation backend for compiled plans
+
+Python source of validation function is generated for a schema tree and
+executed once. Checks of `String`, `Integer` and `Boolean` are inlined,
+`Tuple` positions and `Dict` keys are unrolled. Results and error
+messages are the same as of interpreted plan.
+
+    >>> from procrustes import codegen
+    >>> plan = codegen.compile(schema)
+'''
+
+import __builtin__
+from collections import Iterable
+from itertools import count
+from procrustes import plan, validators
+from procrustes.errors import ValidationError, Error
+from procrustes.results import Result, TupleResult, ListResult, DictResult
+from procrustes.utils import schema_of
+
+
+def compile(schema):
+    '''Build plan with generated validation function
+    '''
+    schema = schema_of(schema)
+    node = plan.node_for(schema)
+    return plan.Plan(schema, GeneratedNode(node, Generator().build(node)))
+
+
+def source(schema):
+    '''Return source of generated validation function, for debugging
+    '''
+    generator = Generator()
+    generator.build(plan.node_for(schema_of(schema)))
+    return '\n'.join(generator.lines)
+
+
+def matches(pattern, value):
+    match = pattern.match(value)
+    return match is not None and match.group() == value
+
+
+class GeneratedNode(plan.Node):
+    '''Node, that validates with generated function
+
+    Fail fast validation and revalidation are left to interpreted node.
+    '''
+    __slots__ = ('node', 'function')
+
+    def __init__(self, node, function):
+        self.required = node.required
+        self.default = node.default
+        self.node = node
+        self.function = function
+
+    def validate(self, raw, fail_fast=False):
+        if fail_fast:
+            return self.node.validate(raw, True)
+        return self.function(raw)
+
+    def revalidate(self, result, tree):
+        return self.node.revalidate(result, tree)
+
+
+class Generator(object):
+
+    def __init__(self):
+        self.lines = []
+        self.counter = count()
+        self.namespace = {
+            'Iterable': Iterable,
+            'ValidationError': ValidationError,
+            'Result': Result,
+            'TupleResult': TupleResult,
+            'ListResult': ListResult,
+            'DictResult': DictResult,
+            'matches': matches,
+        }
+
+    def build(self, node):
+        self.line(0, 'def validate(raw):')
+        self.emit(node, 'raw', 'result', 1)
+        self.line(1, 'return result')
+        code = __builtin__.compile('\n'.join(self.lines),
+                                   '<procrustes.codegen>', 'exec')
+        exec code in self.namespace
+        return self.namespace['validate']
+
+    def line(self, indent, text):
+        self.lines.append('    ' * indent + text)
+
+    def name(self, prefix):
+        return '%s%i' % (prefix, next(self.counter))
+
+    def const(self, value):
+        if value is None or type(value) in (bool, int, long, str, unicode):
+            return repr(value)
+        name = self.name('c')
+        self.namespace[name] = value
+        return name
+
+    def emit(self, node, src, dst, indent):
+        '''Emit code, that validates value of `src` variable and puts result
+        into `dst` variable.
+        '''
+        emitter = self.emitters.get(type(node))
+        if emitter is None:
+            self.line(indent, '%s = %s(%s)'
+                      % (dst, self.const(node.validate), src))
+            return
+        if not node.required:
+            self.line(indent, 'if not %s:' % src)
+            self.line(indent + 1, '%s = %s' % (dst, self.absent(node, src)))
+            self.line(indent, 'else:')
+            indent += 1
+        emitter(self, node, src, dst, indent)
+
+    def absent(self, node, src):
+        if isinstance(node, plan.DictNode):
+            return 'DictResult(%s, absent=True)' % self.const(node.names)
+        if isinstance(node, plan.TupleNode):
+            return 'TupleResult(absent=True)'
+        if isinstance(node, plan.ListNode):
+            return 'ListResult(absent=True)'
+        return 'Result(%s, None, True)' % src
+
+    def checks(self, checks, dst, success, indent):
+        '''Emit chain of `(condition, message)` checks
+        '''
+        keyword = 'if'
+        for condition, message in checks:
+            self.line(indent, '%s %s:' % (keyword, condition))
+            self.line(indent + 1, '%s = %s' % (dst, message))
+            keyword = 'elif'
+        if keyword == 'if':
+            self.line(indent, '%s = %s' % (dst, success))
+            return
+        self.line(indent, 'else:')
+        self.line(indent + 1, '%s = %s' % (dst, success))
+
+    def failed(self, node, code, template, params=()):
+        '''Expression of failed result, error is a constant, commented with
+        its message
+        '''
+        error = Error(code, template, params)
+        return 'Result(%s, %s)  # %r' % (self.const(node.default),
+                                         self.const(error), error.message)
+
+    def emit_scalar(self, node, src, dst, indent):
+        check = node.check_value
+        # memoized checks are partials and are called as they are
+        schema = getattr(check, 'im_self', None)
+        if schema is not None:
+            if validators.own_checks(schema, validators.String):
+                return self.emit_string(node, schema, src, dst, indent)
+            if validators.own_checks(schema, validators.Integer):
+                return self.emit_integer(node, schema, src, dst, indent)
+            if validators.own_checks(schema, validators.Boolean):
+                self.line(indent, '%s = Result(bool(%s))' % (dst, src))
+                return
+        self.line(indent, 'try:')
+        self.line(indent + 1, '%s = Result(%s(%s))'
+                  % (dst, self.const(check), src))
+        self.line(indent, 'except ValidationError as e:')
+        self.line(indent + 1, '%s = Result(%s, e.args[0])'
+                  % (dst, self.const(node.default)))
+
+    def emit_string(self, node, schema, src, dst, indent):
+        self.line(indent, 'if not isinstance(%s, basestring):' % src)
+        self.line(indent + 1, '%s = %s' % (dst, self.failed(
+                  node, 'type', 'Must be str or unicode instance')))
+        self.line(indent, 'else:')
+        indent += 1
+        checks = []
+        if schema.min_length is not None:
+            checks.append(('len(%s) < %r' % (src, schema.min_length),
+                           self.failed(node, 'min_length',
+                                       'Must be longer than %i',
+                                       (schema.min_length,))))
+        if schema.max_length is not None:
+            checks.append(('len(%s) > %r' % (src, schema.max_length),
+                           self.failed(node, 'max_length',
+                                       'Must be shorter than %i',
+                                       (schema.max_length,))))
+        if schema.regex:
+            checks.append(('not matches(%s, %s)'
+                           % (self.const(schema.regex), src),
+                           self.failed(node, 'regex', schema.regex_msg)))
+        self.checks(checks, dst, 'Result(%s)' % src, indent)
+
+    def emit_integer(self, node, schema, src, dst, indent):
+        number = self.name('i')
+        self.line(indent, 'try:')
+        self.line(indent + 1, '%s = int(%s)' % (number, src))
+        self.line(indent, 'except (ValueError, TypeError):')
+        self.line(indent + 1, '%s = %s' % (dst, self.failed(
+                  node, 'type', 'Must be number, not a string')))
+        self.line(indent, 'else:')
+        indent += 1
+        checks = []
+        if schema.min is not None:
+            checks.append(('%s < %s' % (number, self.const(schema.min)),
+                           self.failed(node, 'min', 'Must be larger than %i',
+                                       (schema.min,))))
+        if schema.max is not None:
+            checks.append(('%s > %s' % (number, self.const(schema.max)),
+                           self.failed(node, 'max', 'Must be smaller than %i',
+                                       (schema.max,))))
+        self.checks(checks, dst, 'Result(%s)' % number, indent)
+
+    def emit_tuple(self, node, src, dst, indent):
+        values = self.name('t')
+        self.line(indent, 'if not isinstance(%s, Iterable):' % src)
+        self.line(indent + 1, '%s = TupleResult(error=%s)'
+                  % (dst, self.const(plan.NOT_ITERABLE)))
+        self.line(indent, 'else:')
+        self.line(indent + 1, '%s = tuple(%s)' % (values, src))
+        self.line(indent + 1, 'if len(%s) != %i:' % (values, len(node.nodes)))
+        self.line(indent + 2, '%s = TupleResult(error=%s)'
+                  % (dst, self.const(node.length_error)))
+        self.line(indent + 1, 'else:')
+        children = []
+        for number, child in enumerate(node.nodes):
+            value, result = self.name('v'), self.name('r')
+            self.line(indent + 2, '%s = %s[%i]' % (value, values, number))
+            self.emit(child, value, result, indent + 2)
+            children.append(result)
+        self.line(indent + 2, '%s = TupleResult([%s])'
+                  % (dst, ', '.join(children)))
+
+    def emit_list(self, node, src, dst, indent):
+        if node.column is not None or node.max_length is not None:
+            # scalars are checked at once, or length is bounded, by
+            # interpreted node
+            self.line(indent, '%s = %s(%s)'
+                      % (dst, self.const(node.validate), src))
+            return
+        children, value, result = self.name('l'), self.name('v'), \
+            self.name('r')
+        self.line(indent, 'if not isinstance(%s, Iterable):' % src)
+        self.line(indent + 1, '%s = ListResult(error=%s)'
+                  % (dst, self.const(plan.NOT_ITERABLE)))
+        self.line(indent, 'else:')
+        self.line(indent + 1, '%s = []' % children)
+        self.line(indent + 1, 'for %s in %s:' % (value, src))
+        self.emit(node.node, value, result, indent + 2)
+        self.line(indent + 2, '%s.append(%s)' % (children, result))
+        self.line(indent + 1, '%s = ListResult(%s)' % (dst, children))
+
+    def emit_dict(self, node, src, dst, indent):
+        names = self.const(node.names)
+        self.line(indent, 'if not isinstance(%s, dict):' % src)
+        self.line(indent + 1, '%s = DictResult(%s, error=%s)'
+                  % (dst, names, self.const(plan.NOT_DICT)))
+        self.line(indent, 'else:')
+        children = []
+        for name, child in zip(node.names, node.nodes):
+            value, result = self.name('v'), self.name('r')
+            self.line(indent + 1, '%s = %s.get(%s)'
+                      % (value, src, self.const(name)))
+            self.emit(child, value, result, indent + 1)
+            children.append(result)
+        self.line(indent + 1, '%s = DictResult(%s, [%s])'
+                  % (dst, names, ', '.join(children)))
+
+    emitters = {
+        plan.ScalarNode: emit_scalar,
+        plan.TupleNode: emit_tuple,
+        plan.ListNode: emit_list,
+        plan.DictNode: emit_dict,
+    }
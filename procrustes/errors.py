@@ -0,0 +1,78 @@
+# (c) Svarga project under terms of the new BSD license
+
+
+class ValidationError(Exception):
+
+    def __init__(self, message, path=()):
+        super(ValidationError, self).__init__(message)
+        self.path = path
+
+
+class Error(object):
+    '''Structured validation error
+
+    Message is formatted from `template` and `params` only when it is read.
+    `code` names failed check, `path` holds keys leading to invalid value.
+    '''
+    __slots__ = ('code', 'template', 'params', 'path')
+
+    def __init__(self, code, template, params=(), path=()):
+        self.code = code
+        self.template = template
+        self.params = params
+        self.path = path
+
+    def __reduce__(self):
+        return Error, (self.code, self.template, self.params, self.path)
+
+    @property
+    def message(self):
+        if not self.params:
+            return self.template
+        return self.template % self.params
+
+    def at(self, path):
+        '''Return copy of error, placed by path'''
+        return Error(self.code, self.template, self.params, path + self.path)
+
+    def __str__(self):
+        return str(self.message)
+
+    def __unicode__(self):
+        return unicode(self.message)
+
+    def __repr__(self):
+        return 'Error(%r, %r, path=%r)' % (self.code, self.message, self.path)
+
+    # comparable with messages, as errors were strings before
+    def __eq__(self, other):
+        if isinstance(other, Error):
+            return (self.code, self.message, self.path) == \
+                (other.code, other.message, other.path)
+        return self.message == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.message)
+
+
+def message_of(error):
+    '''Return message of `Error` or of plain string error'''
+    if isinstance(error, Error):
+        return error.message
+    return error
+
+
+class LimitExceeded(Exception):
+    '''Budget of validation is exhausted, see `budgets`
+
+    It is not `ValidationError`, so validation is stopped, not continued
+    with next value.
+    '''
+
+    def __init__(self, error, path=()):
+        super(LimitExceeded, self).__init__(error.message)
+        self.error = error
+        self.path = path
@@ -0,0 +1,98 @@
+# (c) Svarga project under terms of the new BSD license
+'''Streaming decoding of flat data
+
+Flat `(key, value)` pairs are consumed one by one, i.e. right from
+multipart parser. Rows of lists are validated and emitted as soon as they
+are complete, so memory is bounded by the size of one row, not of a form.
+'''
+
+from ordereddict import OrderedDict
+from procrustes import validators
+from procrustes.plan import node_for
+from procrustes.utils import schema_of
+
+
+def put(tree, parts, value):
+    for part in parts:
+        tree = tree.setdefault(part, {})
+    tree[''] = value
+
+
+class FlatDecoder(object):
+    '''Decode and validate flat pairs with schema
+
+    Streamed are outermost lists of the schema, their rows are yielded as
+    `(path, result)`, where path ends with index of row. Keys of every row
+    must come together, as they do in forms. Last yielded item is
+    `((), result)` for the rest of data, with streamed lists left empty.
+    '''
+
+    def __init__(self, schema, delimiter='__'):
+        self.schema = schema_of(schema)
+        self.delimiter = delimiter
+        self.root = node_for(self.schema)
+        self.streams = self.find_lists(self.schema)
+
+    def find_lists(self, schema):
+        '''Build tree of keys, leading to outermost lists
+
+        Leaf of this tree is `(schema, node)` of list items.
+        '''
+        if isinstance(schema, validators.List):
+            typ = schema_of(schema.type)
+            return typ, node_for(typ)
+        if isinstance(schema, validators.Dict):
+            children = schema.named_types.iteritems()
+        elif isinstance(schema, validators.Tuple):
+            children = ((str(number), typ) for number, typ
+                        in enumerate(schema.types))
+        else:
+            return None
+        found = {}
+        for key, typ in children:
+            streams = self.find_lists(schema_of(typ))
+            if streams is not None:
+                found[key] = streams
+        return found or None
+
+    def iterdecode(self, pairs):
+        delimiter = self.delimiter
+        rest = {}
+        rows = OrderedDict()
+        for key, value in pairs:
+            parts = [part for part in key.split(delimiter) if part]
+            streams = self.streams
+            depth = 0
+            while isinstance(streams, dict) and depth < len(parts):
+                streams = streams.get(parts[depth])
+                depth += 1
+            if not (isinstance(streams, tuple) and depth < len(parts)
+                    and parts[depth].isdigit()):
+                put(rest, parts, value)
+                continue
+            path = tuple(parts[:depth])
+            number = int(parts[depth])
+            row = rows.get(path)
+            if row is None:
+                # streamed list deepens to empty list in the rest of data
+                put(rest, path, None)
+            elif row[0] != number:
+                yield self.close(path, row, streams)
+                row = None
+            if row is None:
+                row = rows[path] = [number, {}]
+            put(row[1], parts[depth + 1:], value)
+        for path, row in rows.iteritems():
+            yield self.close(path, row, self.streams_at(path))
+        yield (), self.root.validate(self.schema.deepen_tree(rest))
+
+    def streams_at(self, path):
+        streams = self.streams
+        for key in path:
+            streams = streams[key]
+        return streams
+
+    def close(self, path, row, streams):
+        schema, node = streams
+        number, tree = row
+        return path + (number,), node.validate(schema.deepen_tree(tree))
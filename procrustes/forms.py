@@ -1,10 +1,29 @@
 # (c) Svarga project under terms of the new BSD license
 
 from functools import partial
-from procrustes import validators, widgets, utils
+from weakref import WeakKeyDictionary
+from procrustes import validators, widgets, utils, flat
+from procrustes.utils import prototype_of
 from ordereddict import OrderedDict
 
 
+# Template widgets depend only on schema, they are cached by origin of field
+# and `(id, delimiter, parent)`. Rebuilt schema is new origin, entries of
+# old one are dropped with it. Callers get copies of cached widgets.
+template_cache = WeakKeyDictionary()
+
+
+def cached_templates(field, build, id, delimiter, parent):
+    cache = template_cache.get(field.origin)
+    if cache is None:
+        cache = template_cache[field.origin] = {}
+    key = (id, delimiter, parent)
+    templates = cache.get(key)
+    if templates is None:
+        templates = cache[key] = tuple(build(id, delimiter, parent))
+    return (widget.clone() for widget in templates)
+
+
 # Fields
 class FieldMixin(object):
     def configure(self, args, kwargs):
@@ -27,6 +46,13 @@ class FieldMixin(object):
         flat = dict((key[pos:], value) for key, value in flat.iteritems())
         return self.deepen(flat, delimiter=delimiter)
 
+    def iterunflat(self, pairs, delimiter='__'):
+        '''Validate flat pairs as they come, see `flat.FlatDecoder`
+        '''
+        pos = len(self.prefix) + 2
+        decoder = flat.FlatDecoder(self, delimiter)
+        return decoder.iterdecode((key[pos:], value) for key, value in pairs)
+
     def is_valid(self, delimiter='__'):
         self.raw_data = self.unflat(self.raw_data, delimiter=delimiter)
         self.validate(safe=True)
@@ -46,6 +72,10 @@ class IterableMixin(object):
                 yield widget
 
     def template_widgets(self, id='', delimiter='__', parent=''):
+        return cached_templates(self, self.build_templates, id, delimiter,
+                                parent)
+
+    def build_templates(self, id, delimiter, parent):
         return self.widgets(id, delimiter, parent, 'template_widgets')
 
 
@@ -68,6 +98,10 @@ class List(IterableMixin, FieldMixin, validators.List):
             yield marker(marker='stop')
 
     def template_widgets(self, id='', delimiter='__', parent=''):
+        return cached_templates(self, self.build_templates, id, delimiter,
+                                parent)
+
+    def build_templates(self, id, delimiter, parent):
         prefix = id + delimiter if id else ''
         marker = partial(widgets.Marker, id=prefix,
                          parent=parent + id, label_name=self.type.field_name)
@@ -92,14 +126,75 @@ class Dict(FieldMixin, validators.Dict):
                 yield widget
 
     def template_widgets(self, id='', delimiter='__', parent=''):
+        return cached_templates(self, self.build_templates, id, delimiter,
+                                parent)
+
+    def build_templates(self, id, delimiter, parent):
         return self.widgets(id, delimiter, parent, 'template_widgets')
 
     def __getattr__(self, attr):
         if attr not in self.named_types:
-            raise AttributeError('Atribute %s does not exist' % attr)
+            # deferred data of lazy form, or error
+            return validators.Dict.__getattr__(self, attr)
         return self.get_included()[attr]
 
 
+class Union(FieldMixin, validators.Union):
+    '''Widgets are widgets of chosen type, or of first type of blank form
+    '''
+    def widgets(self, id='', delimiter='__', parent='', attribute='widgets'):
+        field = self.get_included()
+        if not hasattr(field, attribute):
+            return iter(())
+        return getattr(field, attribute)(id, delimiter, parent)
+
+    def template_widgets(self, id='', delimiter='__', parent=''):
+        return cached_templates(self, self.build_templates, id, delimiter,
+                                parent)
+
+    def build_templates(self, id, delimiter, parent):
+        field = prototype_of(self.types[0])
+        if not hasattr(field, 'template_widgets'):
+            return iter(())
+        return field.template_widgets(id, delimiter, parent)
+
+
+class OneOf(Union, validators.OneOf):
+    pass
+
+
+class Tagged(FieldMixin, validators.Tagged):
+    '''Widget of tag, if variant has no field for it, is followed by
+    widgets of chosen variant, or of first variant of blank form
+    '''
+    def widgets(self, id='', delimiter='__', parent='', attribute='widgets'):
+        if self.absent or self.validated_data is None:
+            tag = sorted(self.variants)[0]
+        else:
+            tag = self.tag
+        return self.variant_widgets(self.get_included(), tag, id, delimiter,
+                                    parent, attribute)
+
+    def variant_widgets(self, field, tag, id, delimiter, parent, attribute):
+        if self.key not in field.named_types:
+            prefix = id + delimiter if id else ''
+            yield self.widget(data=tag, id=prefix + self.key, error=None,
+                              delimiter=delimiter, parent=parent,
+                              label_name=self.key, **self.widget_kwargs)
+        if hasattr(field, attribute):
+            for widget in getattr(field, attribute)(id, delimiter, parent):
+                yield widget
+
+    def template_widgets(self, id='', delimiter='__', parent=''):
+        return cached_templates(self, self.build_templates, id, delimiter,
+                                parent)
+
+    def build_templates(self, id, delimiter, parent):
+        tag = sorted(self.variants)[0]
+        return self.variant_widgets(prototype_of(self.variants[tag]), tag, id,
+                                    delimiter, parent, 'template_widgets')
+
+
 class String(FieldMixin, validators.String):
     pass
 
@@ -125,5 +220,5 @@ class DeclarativeFieldMeta(validators.DeclarativeMeta):
         return validators.DeclarativeMeta.__new__(cls, name, bases, attrs)
 
 
-class Declarative(Dict):
+class Declarative(Dict, validators.Declarative):
     __metaclass__ = DeclarativeFieldMeta
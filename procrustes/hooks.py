@@ -0,0 +1,183 @@
+# (c) Svarga project under terms of the new BSD license
+'''Checks with I/O
+
+Hooks are custom checks, that look values up in databases or other
+services. Any validator takes `hooks` argument. Hook is called once with all
+valid values of its validator in data, i.e. with every item of a list, so
+lookups are batched, and returns list of errors, None for good values:
+
+    def free_names(names):
+        taken = set(db.taken_names(names))
+        return ['Name is taken' if name in taken else None for name in names]
+
+    >>> schema = v.List(v.String(hooks=[free_names]))
+    >>> future = schema.avalidate(data, callback=respond)
+    >>> result = future.get()
+
+Data is validated by compiled plan first, then hooks of different
+validators run concurrently, at most `limit` at once. Python 2 has no
+asyncio, so hooks are run in threads and `avalidate` returns `Future`,
+result is passed to `callback` as well. Synchronous validation does not run
+hooks and does not pay for them.
+'''
+
+import sys
+from threading import Event, Lock, Thread
+from ordereddict import OrderedDict
+from procrustes import plan, validators
+from procrustes.utils import schema_of
+
+
+def plan_of(schema):
+    plan = schema.__dict__.get('_hooks_plan')
+    if plan is None:
+        plan = schema._hooks_plan = schema.compile()
+    return plan
+
+
+def validate(schema, data=None, limit=8):
+    '''Validate data and run hooks, return result
+    '''
+    schema = schema_of(schema)
+    result = plan_of(schema)(data)
+    batches = OrderedDict()
+    collect(schema, result, batches)
+    tasks = [(hook, results, typ.default_data)
+             for typ, results in batches.iteritems() for hook in typ.hooks]
+    run(tasks, limit)
+    return result
+
+
+def union_of(schema):
+    node = schema.__dict__.get('_hooks_union')
+    if node is None:
+        node = schema._hooks_union = plan.UnionNode(schema)
+    return node
+
+
+def collect(schema, result, batches, chosen=None):
+    '''Group valid results by validators with hooks, `chosen` are indexes
+    of types of nested unions, that are not collected yet
+    '''
+    if result.error or result.absent:
+        return
+    if schema.hooks:
+        batches.setdefault(schema, []).append(result)
+    # result of union is result of chosen type
+    if isinstance(schema, validators.Union):
+        if chosen is None:
+            chosen = getattr(result, 'chosen', ())
+        if chosen:
+            index, chosen = chosen[0], chosen[1:]
+        else:
+            # union compiled to other node
+            index = union_of(schema).index_of(result.data)
+        if index is not None:
+            collect(schema_of(schema.types[index]), result, batches, chosen)
+        return
+    if isinstance(schema, validators.Tagged):
+        typ = schema.variant_of(result.data.get(schema.key))
+        if typ is not None:
+            # result of variant is rebuilt with tag, it has no indexes
+            collect(schema_of(typ), result, batches, ())
+        return
+    items = result.flat_items()
+    if not items:
+        return
+    if isinstance(schema, validators.List):
+        typ = schema_of(schema.type)
+        for key, child in items:
+            collect(typ, child, batches)
+    elif isinstance(schema, validators.Dict):
+        for key, child in items:
+            # tag of variant of `Tagged` may have no field
+            typ = schema.named_types.get(key)
+            if typ is not None:
+                collect(schema_of(typ), child, batches)
+    elif isinstance(schema, validators.Tuple):
+        for key, child in items:
+            collect(schema_of(schema.types[int(key)]), child, batches)
+
+
+def call(hook, results, default=None):
+    '''Call hook with valid values, rejected values are replaced by
+    `default`, as values of failed checks
+    '''
+    # values rejected by other hook of validator are skipped
+    results = [result for result in results if not result.error]
+    if not results:
+        return
+    errors = list(hook([result.data for result in results]))
+    if len(errors) != len(results):
+        raise ValueError('Hook %s returned %i errors for %i values'
+                         % (getattr(hook, '__name__', hook), len(errors),
+                            len(results)))
+    for result, error in zip(results, errors):
+        if error:
+            result.fail(error, default)
+
+
+def run(tasks, limit):
+    '''Call hooks in at most `limit` threads, first exception is reraised
+    '''
+    if len(tasks) < 2 or limit < 2:
+        for task in tasks:
+            call(*task)
+        return
+    count = min(limit, len(tasks))
+    tasks = iter(tasks)
+    lock = Lock()
+    failures = []
+
+    def worker():
+        while not failures:
+            with lock:
+                task = next(tasks, None)
+            if task is None:
+                return
+            try:
+                call(*task)
+            except Exception:
+                failures.append(sys.exc_info())
+
+    threads = [Thread(target=worker) for i in xrange(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+
+
+class Future(object):
+    '''Result of validation, that runs in background thread
+    '''
+
+    def __init__(self, func, args, callback=None):
+        self.event = Event()
+        self.result = None
+        self.exc_info = None
+        self.callback = callback
+        thread = Thread(target=self.run, args=(func, args))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, func, args):
+        try:
+            self.result = func(*args)
+            if self.callback is not None:
+                self.callback(self.result)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.event.set()
+
+    def ready(self):
+        return self.event.is_set()
+
+    def get(self, timeout=None):
+        self.event.wait(timeout)
+        if not self.event.is_set():
+            raise RuntimeError('Validation is not finished')
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
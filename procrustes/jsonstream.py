@@ -0,0 +1,423 @@
+# (c) Svarga project under terms of the new BSD license
+'''Validation of JSON while it is parsed
+
+    >>> from procrustes import jsonstream
+    >>> decoder = jsonstream.JSONDecoder(schema)
+    >>> result = decoder.decode(request.stream)
+
+Source is `str`, `memoryview` or file-like object with `read`, it is read
+by chunks. Tokens are pulled by plan nodes of schema, so values are
+validated as soon as they are parsed, and decoding stops on first error,
+as fail fast validation of plan does: `FailedResult` with error and path is
+returned. Values of unknown keys of objects are skipped without decoding,
+only their brackets are checked.
+
+Arrays are accepted only by `List` and `Tuple` and objects only by `Dict`,
+other values are decoded and validated by plan nodes as they are. With
+limits strings are counted by bytes of input.
+'''
+
+import re
+from json.decoder import scanstring
+from procrustes import budgets, plan
+from procrustes.errors import ValidationError, LimitExceeded
+from procrustes.results import ListResult, TupleResult, DictResult, \
+    FailedResult
+from procrustes.utils import schema_of
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING_CHARS = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?')
+LITERAL = re.compile(r'true|false|null')
+LITERALS = {'true': True, 'false': False, 'null': None}
+CLOSING = {'{': '}', '[': ']'}
+
+
+def invalid(reason):
+    return ValidationError('Invalid JSON: %s' % reason)
+
+
+def partial(rest):
+    '''Check if rest of buffer may start number or literal'''
+    return rest == '-' or any(word.startswith(rest) for word in LITERALS)
+
+
+def read_chunks(stream, size):
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def view_chunks(view, size):
+    for start in xrange(0, len(view), size):
+        yield view[start:start + size].tobytes()
+
+
+class Reader(object):
+    '''Tokenizer, that reads source by chunks on demand
+    '''
+
+    def __init__(self, source, chunk_size=65536, budget=None):
+        self.pos = 0
+        self.chunks = None
+        self.budget = budget
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        if isinstance(source, str):
+            self.buffer = source
+            return
+        self.buffer = ''
+        if isinstance(source, memoryview):
+            self.chunks = view_chunks(source, chunk_size)
+        else:
+            self.chunks = read_chunks(source, chunk_size)
+
+    def next_chunk(self):
+        '''Read next chunk of source, None at the end'''
+        if self.chunks is None:
+            return None
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.chunks = None
+        return chunk
+
+    def more(self):
+        '''Append next chunk to buffer, return False at the end of source
+        '''
+        chunk = self.next_chunk()
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''Skip whitespace and return next character, empty at the end
+        '''
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise invalid('expecting %r' % char)
+        self.pos += 1
+
+    def match(self, pattern):
+        '''Match number or literal, that may continue in next chunk
+
+        Fails as soon as buffered input can not start token. Token is
+        matched again after next chunk while it ends at last two characters
+        of buffer, as fraction or exponent may follow.
+        '''
+        while True:
+            match = pattern.match(self.buffer, self.pos)
+            if match is not None:
+                if match.end() + 2 < len(self.buffer) or not self.more():
+                    break
+            elif not partial(self.buffer[self.pos:]) or not self.more():
+                raise invalid('unexpected %r' %
+                              self.buffer[self.pos:self.pos + 1])
+        self.pos = match.end()
+        return match
+
+    def open(self):
+        '''Consume opening bracket and count container in budget'''
+        self.pos += 1
+        if self.budget is not None:
+            self.budget.node()
+            self.budget.descend()
+
+    def close(self):
+        if self.budget is not None:
+            self.budget.ascend()
+
+    def raw_string(self):
+        '''Consume string without decoding, its bytes are counted in budget
+
+        Return text and offset of opening quote in it. String is scanned
+        from the last scanned offset as chunks are read, so text is joined
+        only for strings, that do not fit in buffer. Bytes are counted as
+        they are scanned, so budget fails before the rest is read.
+        '''
+        buffer, start = self.buffer, self.pos
+        pieces = []
+        scanned = start + 1
+        while True:
+            end = STRING_CHARS.match(buffer, scanned).end()
+            if self.budget is not None:
+                self.budget.string(end - scanned)
+            if end < len(buffer) and buffer[end] == '"':
+                break
+            # escape may be split by chunks, so backslash is scanned again
+            chunk = self.next_chunk()
+            if chunk is None:
+                raise invalid('unterminated string')
+            pieces.append(buffer[start:end])
+            buffer = buffer[end:] + chunk
+            start = scanned = 0
+        self.buffer, self.pos = buffer, end + 1
+        if not pieces:
+            return buffer, start
+        pieces.append(buffer[:end + 1])
+        return ''.join(pieces), 0
+
+    def string(self):
+        text, start = self.raw_string()
+        try:
+            return scanstring(text, start + 1, 'utf-8', True)[0]
+        except ValueError as e:
+            raise invalid(e.args[0])
+
+    def scalar(self):
+        char = self.peek()
+        if char == '"':
+            return self.string()
+        match = self.token()
+        if match.re is LITERAL:
+            return LITERALS[match.group()]
+        if match.group(1) or match.group(2):
+            return float(match.group())
+        return int(match.group())
+
+    def token(self):
+        '''Match number or literal'''
+        char = self.peek()
+        if char == '-' or char.isdigit():
+            return self.match(NUMBER)
+        return self.match(LITERAL)
+
+    def value(self):
+        '''Decode any value'''
+        char = self.peek()
+        if char == '{':
+            self.open()
+            value = {}
+            if self.peek() == '}':
+                self.pos += 1
+            else:
+                while True:
+                    if self.peek() != '"':
+                        raise invalid('expecting property name')
+                    key = self.string()
+                    self.expect(':')
+                    value[key] = self.value()
+                    if not self.separator('}'):
+                        break
+            self.close()
+            return value
+        if char == '[':
+            self.open()
+            value = []
+            if self.peek() == ']':
+                self.pos += 1
+            else:
+                while True:
+                    value.append(self.value())
+                    if not self.separator(']'):
+                        break
+            self.close()
+            return value
+        if char == '':
+            raise invalid('unexpected end of data')
+        if self.budget is not None:
+            self.budget.node()
+        return self.scalar()
+
+    def separator(self, closing):
+        '''Consume comma and return True, or closing bracket and False'''
+        char = self.peek()
+        self.pos += 1
+        if char == ',':
+            return True
+        if char == closing:
+            return False
+        self.pos -= 1
+        raise invalid('expecting %r or %r' % (',', closing))
+
+    def key(self):
+        '''Skip property name and colon'''
+        if self.peek() != '"':
+            raise invalid('expecting property name')
+        self.raw_string()
+        self.expect(':')
+
+    def skip(self):
+        '''Skip value without decoding it, its syntax is checked'''
+        brackets = []
+        while True:
+            char = self.peek()
+            if char in CLOSING:
+                self.open()
+                brackets.append(CLOSING[char])
+                if self.peek() != brackets[-1]:
+                    if char == '{':
+                        self.key()
+                    continue
+                self.pos += 1
+                brackets.pop()
+                self.close()
+            elif char == '':
+                raise invalid('unexpected end of data')
+            elif char == '"':
+                self.raw_string()
+            else:
+                if self.budget is not None:
+                    self.budget.node()
+                self.token()
+            while brackets:
+                if self.separator(brackets[-1]):
+                    if brackets[-1] == '}':
+                        self.key()
+                    break
+                brackets.pop()
+                self.close()
+            if not brackets:
+                return
+
+
+class JSONDecoder(object):
+    '''Decode and validate JSON with schema
+    '''
+
+    def __init__(self, schema, chunk_size=65536):
+        self.schema = schema_of(schema)
+        self.root = plan.node_for(self.schema)
+        self.chunk_size = chunk_size
+
+    def decode(self, source, limits=None):
+        '''Decode and validate source, `limits` override limits of schema,
+        see `budgets`. Skipped values are counted too.
+        '''
+        if limits is None:
+            limits = self.schema.limits
+        if limits is None or budgets.current() is not None:
+            return self.validate(Reader(source, self.chunk_size))
+        with budgets.Budget(limits) as budget:
+            try:
+                return self.validate(Reader(source, self.chunk_size, budget))
+            except LimitExceeded as e:
+                return FailedResult(e.error, e.path)
+
+    def validate(self, reader):
+        try:
+            result = self.parse(self.root, reader)
+            if reader.peek() != '':
+                raise invalid('extra data')
+        except ValidationError as e:
+            return FailedResult(e.args[0], e.path)
+        return result
+
+    def parse(self, node, reader):
+        parser = self.parsers.get(type(node))
+        if parser is None:
+            return node.validate(reader.value(), True)
+        return parser(self, node, reader)
+
+    def other(self, node, reader, error, rejected):
+        '''Validate value, that is not a container of node, values of
+        `rejected` kinds fail at once if node is required.
+        '''
+        if reader.peek() in rejected and node.required:
+            raise ValidationError(error.message)
+        return node.validate(reader.value(), True)
+
+    def parse_dict(self, node, reader):
+        if reader.peek() != '{':
+            return self.other(node, reader, plan.NOT_DICT, '[')
+        reader.open()
+        children = [None] * len(node.nodes)
+        empty = reader.peek() == '}'
+        if empty:
+            reader.pos += 1
+        while not empty:
+            if reader.peek() != '"':
+                raise invalid('expecting property name')
+            key = reader.string()
+            reader.expect(':')
+            position = node.positions.get(key)
+            if position is None:
+                reader.skip()
+            else:
+                children[position] = plan.validate_child(
+                    ParsedNode(self, node.nodes[position]),
+                    node.names[position], reader)
+            if not reader.separator('}'):
+                break
+        reader.close()
+        if empty and not node.required:
+            return node.absent({})
+        for position, child in enumerate(children):
+            if child is None:
+                children[position] = plan.validate_child(
+                    node.nodes[position], node.names[position], None)
+        return DictResult(node.names, children)
+
+    def parse_list(self, node, reader):
+        if reader.peek() != '[':
+            return self.other(node, reader, plan.NOT_ITERABLE, '{"')
+        reader.open()
+        children = []
+        if reader.peek() == ']':
+            reader.pos += 1
+            reader.close()
+            if not node.required:
+                return node.absent([])
+            return ListResult(children)
+        item = ParsedNode(self, node.node)
+        while True:
+            if len(children) == node.max_length:
+                raise ValidationError(node.length_error.message)
+            children.append(plan.validate_child(item, len(children), reader))
+            if not reader.separator(']'):
+                reader.close()
+                return ListResult(children)
+
+    def parse_tuple(self, node, reader):
+        if reader.peek() != '[':
+            return self.other(node, reader, plan.NOT_ITERABLE, '{"')
+        reader.open()
+        children = []
+        if reader.peek() == ']':
+            reader.pos += 1
+            reader.close()
+            if not node.required:
+                return node.absent(())
+        else:
+            while True:
+                if len(children) == len(node.nodes):
+                    raise ValidationError(node.length_error.message)
+                child = ParsedNode(self, node.nodes[len(children)])
+                children.append(plan.validate_child(child, len(children),
+                                                    reader))
+                if not reader.separator(']'):
+                    reader.close()
+                    break
+        if len(children) != len(node.nodes):
+            raise ValidationError(node.length_error.message)
+        return TupleResult(children)
+
+    parsers = {
+        plan.DictNode: parse_dict,
+        plan.ListNode: parse_list,
+        plan.TupleNode: parse_tuple,
+    }
+
+
+class ParsedNode(object):
+    '''Adapter for `plan.validate_child`, child is validated as it is read
+    '''
+    __slots__ = ('decoder', 'node')
+
+    def __init__(self, decoder, node):
+        self.decoder = decoder
+        self.node = node
+
+    def validate(self, reader, fail_fast=True):
+        return self.decoder.parse(self.node, reader)
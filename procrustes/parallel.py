@@ -0,0 +1,128 @@
+# (c) Svarga project under terms of the new BSD license
+'''Parallel validation of long lists
+
+    >>> from procrustes import parallel
+    >>> with parallel.ListPlan(v.List(Record), processes=4) as plan:
+    ...     result = plan(records)
+
+Items are split to chunks, chunks are validated by pool of processes and
+results are merged in order, so indexes of items and paths of errors are
+the same as of serial validation. Schema of items is sent to every worker
+once, when pool is started, and is compiled there. Chunks carry only raw
+items and results. At most `window` chunks are submitted at once, so
+generators are consumed as chunks are validated.
+'''
+
+from collections import Iterable, deque
+from itertools import count, islice
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from procrustes import validators
+from procrustes.errors import ValidationError
+from procrustes.plan import Plan, node_for
+from procrustes.results import ListResult, FailedResult
+from procrustes.utils import schema_of, take
+
+
+# Nodes of items in worker, by key of plan
+nodes = {}
+keys = count()
+
+
+def setup(key, schema):
+    nodes[key] = node_for(schema)
+
+
+def validate_chunk(task):
+    '''Validate chunk of items in worker
+
+    With `fail_fast` first error is returned as `FailedResult`, its path
+    starts with index of item in the whole list.
+    '''
+    key, start, chunk, fail_fast = task
+    node = nodes[key]
+    if not fail_fast:
+        return [node.validate(raw) for raw in chunk]
+    results = []
+    for index, raw in enumerate(chunk, start):
+        try:
+            results.append(node.validate(raw, True))
+        except ValidationError as e:
+            return FailedResult(e.args[0], (index,) + e.path)
+    return results
+
+
+def chunks(iterable, size):
+    '''Yield `(start, items)` chunks of iterable'''
+    iterator = iter(iterable)
+    start = 0
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+class ListPlan(object):
+    '''Plan of `List`, that validates items in pool
+
+    Lists not longer than `chunk_size` are validated in place. With
+    `threads` pool of threads is used, it pays off only on interpreters
+    without global lock. `window` is count of chunks in pool at once, twice
+    count of processes by default.
+    '''
+
+    def __init__(self, schema, processes=None, chunk_size=1000,
+                 threads=False, window=None):
+        schema = schema_of(schema)
+        if not isinstance(schema, validators.List):
+            raise TypeError('Schema must be List, not %r' % schema)
+        self.plan = Plan(schema)
+        self.chunk_size = chunk_size
+        self.window = window or 2 * (processes or cpu_count())
+        self.key = next(keys)
+        pool = ThreadPool if threads else Pool
+        self.pool = pool(processes, setup, (self.key, schema.type))
+
+    def __call__(self, data=None, fail_fast=False):
+        root = self.plan.root
+        if (not root.required and not data) or \
+           not isinstance(data, Iterable) or \
+           isinstance(data, (list, tuple)) and len(data) <= self.chunk_size \
+           or self.plan.limits is not None:
+            # budget of limits is not shared by workers
+            return self.plan(data, fail_fast)
+        if root.max_length is not None:
+            data = take(data, root.max_length)
+            if data is None:
+                if fail_fast:
+                    return FailedResult(root.length_error)
+                return root.failed(root.length_error)
+        children = []
+        pending = deque()
+        tasks = chunks(data, self.chunk_size)
+        while True:
+            for start, chunk in islice(tasks, self.window - len(pending)):
+                pending.append(self.pool.apply_async(
+                    validate_chunk, ((self.key, start, chunk, fail_fast),)))
+            if not pending:
+                return ListResult(children)
+            results = pending.popleft().get()
+            if isinstance(results, FailedResult):
+                # pool is reused, submitted chunks are finished
+                for task in pending:
+                    task.wait()
+                return results
+            children.extend(results)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        nodes.pop(self.key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
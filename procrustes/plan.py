@@ -0,0 +1,653 @@
+# (c) Svarga project under terms of the new BSD license
+'''Compiled validation plans
+
+Plan is built once from a validator tree and then validates any amount of
+data, without copying validators and running `configure` again.
+'''
+
+from collections import Iterable
+from copy import copy
+from functools import partial
+from itertools import izip
+from procrustes import budgets, profiling
+from procrustes.errors import ValidationError, Error, LimitExceeded, \
+    message_of
+from procrustes.results import (Result, TupleResult, ListResult, DictResult,
+                                ArrayResult, FailedResult)
+from procrustes.utils import schema_of, flat_tree, take, kind_of
+
+
+# Errors of containers, nodes return them without raising
+NOT_ITERABLE = Error('type', 'Must be iterable')
+NOT_DICT = Error('type', 'Value must be dict')
+
+
+def node_for(typ):
+    '''Compile validator, or `Declarative` class, into a plan node
+    '''
+    return schema_of(typ).compile_node()
+
+
+def validate_child(node, key, raw):
+    '''Fail fast validation of child value, error path is extended with key
+    '''
+    try:
+        return node.validate(raw, True)
+    except ValidationError as e:
+        e.path = (key,) + e.path
+        raise
+
+
+def merge_tree(data, tree):
+    '''Apply tree of changes, made by `utils.flat_tree`, to copy of data
+    '''
+    if '' in tree:
+        return tree['']
+    if isinstance(data, dict):
+        data = dict(data)
+        for key, child in tree.iteritems():
+            data[key] = merge_tree(data.get(key), child)
+        return data
+    if data is None and not all(key.isdigit() for key in tree):
+        return dict((key, merge_tree(None, child))
+                    for key, child in tree.iteritems())
+    if data is not None and not isinstance(data, (list, tuple)):
+        return data
+    items = list(data or ())
+    for number, child in sorted((int(key), child) for key, child
+                                in tree.iteritems() if key.isdigit()):
+        if number < len(items):
+            items[number] = merge_tree(items[number], child)
+        else:
+            items.append(merge_tree(None, child))
+    return tuple(items) if isinstance(data, tuple) else items
+
+
+def instrument(node, path=(), wrapper=None):
+    '''Copy node tree, wrapping every node into `ProfiledNode`, or into
+    `wrapper(node, path)`
+    '''
+    node = copy(node)
+    if isinstance(node, ListNode):
+        # items are validated one by one to be profiled
+        node.column = None
+        node.node = instrument(node.node, path + ('*',), wrapper)
+    elif isinstance(node, DictNode):
+        node.nodes = tuple(instrument(child, path + (name,), wrapper)
+                           for name, child in zip(node.names, node.nodes))
+    elif isinstance(node, TupleNode):
+        node.nodes = tuple(instrument(child, path + (str(number),), wrapper)
+                           for number, child in enumerate(node.nodes))
+    elif isinstance(node, UnionNode):
+        # chosen type has path of union
+        node.nodes = tuple(instrument(child, path, wrapper)
+                           for child in node.nodes)
+        node.arrange()
+    elif isinstance(node, TaggedNode):
+        node.variants = dict((tag, instrument(child, path, wrapper))
+                             for tag, child in node.variants.iteritems())
+    if wrapper is not None:
+        return wrapper(node, path)
+    return ProfiledNode(node, profiling.join(path))
+
+
+class Plan(object):
+    __slots__ = ('schema', 'root', 'profiled', 'limits', 'limited')
+
+    def __init__(self, schema, root=None):
+        self.schema = schema
+        self.root = root if root is not None else node_for(schema)
+        self.profiled = None
+        self.limits = schema_of(schema).limits
+        self.limited = None
+
+    def __call__(self, data=None, fail_fast=False, limits=None):
+        '''Validate data and return result
+
+        With `fail_fast` validation stops on first error, and result
+        holds only this error and path to it. `limits` override limits of
+        schema, see `budgets`.
+        '''
+        if limits is None:
+            limits = self.limits
+        if limits is not None and budgets.current() is None:
+            return self.validate_limited(data, fail_fast, limits)
+        root = self.root
+        if profiling.active is not None:
+            if self.profiled is None:
+                self.profiled = instrument(root)
+            root = self.profiled
+        if not fail_fast:
+            return root.validate(data)
+        try:
+            return root.validate(data, True)
+        except ValidationError as e:
+            return FailedResult(e.args[0], e.path)
+
+    def validate_limited(self, data, fail_fast, limits):
+        '''Validate data by nodes, that count values in budget'''
+        if self.limited is None:
+            self.limited = instrument(node_for(self.schema), (), LimitedNode)
+        with budgets.Budget(limits):
+            try:
+                return self.limited.validate(data, fail_fast)
+            except ValidationError as e:
+                return FailedResult(e.args[0], e.path)
+            except LimitExceeded as e:
+                return FailedResult(e.error, e.path)
+
+    def revalidate(self, result, changes, delimiter='__'):
+        '''Validate changed flat keys of data, validated to `result`
+
+        `changes` maps keys, as made by `flatten`, to new raw values. Only
+        subtrees with changed keys are validated again, other children of
+        `result` are reused by returned result. `result` is not changed.
+        '''
+        return self.root.revalidate(result, flat_tree(changes, delimiter))
+
+    def validate_partial(self, data=None, fields=None, fail_fast=False,
+                         limits=None):
+        '''Validate only keys of dict, that are present in data, or only
+        `fields`, and return sparse `DictResult` of them
+
+        Other fields are skipped, result can be merged into result of whole
+        data by `DictResult.merge`.
+        '''
+        if limits is None:
+            limits = self.limits
+        if limits is None or budgets.current() is not None:
+            return self.partial_of(self.root, data, fields, fail_fast)
+        if self.limited is None:
+            self.limited = instrument(node_for(self.schema), (), LimitedNode)
+        with budgets.Budget(limits):
+            try:
+                return self.partial_of(self.limited, data, fields, fail_fast)
+            except LimitExceeded as e:
+                return FailedResult(e.error, e.path)
+
+    def partial_of(self, root, data, fields, fail_fast):
+        # generated, profiled and limited nodes wrap interpreted one
+        while not isinstance(root, DictNode):
+            root = getattr(root, 'node', None)
+            if root is None:
+                raise TypeError('Schema must be Dict, not %r' % self.schema)
+        try:
+            return root.validate_partial(data, fields, fail_fast)
+        except ValidationError as e:
+            return FailedResult(e.args[0], e.path)
+
+    def validate_many(self, iterable, errors_only=False, fail_fast=False):
+        '''Validate every item of iterable, yield `(index, data, errors)`
+
+        With `errors_only` data is not built and only invalid items are
+        yielded as `(index, None, errors)`. `fail_fast` is applied to every
+        item.
+        '''
+        for index, raw in enumerate(iterable):
+            result = self(raw, fail_fast)
+            errors = result.errors
+            if not errors_only:
+                yield index, result.data, errors
+            elif errors:
+                yield index, None, errors
+
+
+# Nodes
+class Node(object):
+    '''Node validates raw value and returns result tree for it
+    '''
+    __slots__ = ('required', 'default')
+
+    def __init__(self, schema):
+        self.required = schema.required
+        self.default = schema.default_data
+
+    def validate(self, raw, fail_fast=False):
+        if not self.required and not raw:
+            return self.absent(raw)
+        try:
+            return self.check(raw, fail_fast)
+        except ValidationError as e:
+            if fail_fast:
+                raise
+            return self.failed(e.args[0])
+
+    def revalidate(self, result, tree):
+        '''Validate tree of changes against previous result'''
+        if '' in tree:
+            return self.validate(tree[''])
+        return self.validate(merge_tree(result.data, tree))
+
+    def absent(self, raw):
+        return Result(raw, absent=True)
+
+    def failed(self, error):
+        return Result(self.default, error)
+
+    def reject(self, error, fail_fast=False):
+        '''Return failed result, or raise error in fail fast mode'''
+        if fail_fast:
+            raise ValidationError(error.message)
+        return self.failed(error)
+
+    def check(self, raw, fail_fast=False):
+        raise NotImplementedError('Define `check` method')
+
+
+class ProfiledNode(Node):
+    __slots__ = ('node', 'path')
+
+    def __init__(self, node, path):
+        self.required = node.required
+        self.default = node.default
+        self.node = node
+        self.path = path
+
+    def validate(self, raw, fail_fast=False):
+        profiler = profiling.active
+        if profiler is None:
+            return self.node.validate(raw, fail_fast)
+        result = None
+        start = profiler.start()
+        try:
+            result = self.node.validate(raw, fail_fast)
+            return result
+        finally:
+            profiler.stop(self.path, start,
+                          result is None or bool(result.error))
+
+
+class LimitedNode(Node):
+    '''Node, that counts values in budget of validation, see `budgets`
+    '''
+    __slots__ = ('node', 'path', 'nested')
+
+    def __init__(self, node, path):
+        self.required = node.required
+        self.default = node.default
+        self.node = node
+        self.path = path
+        self.nested = isinstance(node, (TupleNode, ListNode, DictNode))
+
+    def validate(self, raw, fail_fast=False):
+        budget = budgets.current()
+        budget.count(raw, self.path)
+        if not self.nested:
+            return self.node.validate(raw, fail_fast)
+        budget.descend(self.path)
+        try:
+            return self.node.validate(raw, fail_fast)
+        finally:
+            budget.ascend()
+
+
+class ScalarNode(Node):
+    '''Value is checked by `inspect_value` of schema, that returns error
+    instead of raising it.
+    '''
+    __slots__ = ('check_value', 'check_column', 'inspect')
+
+    def __init__(self, schema):
+        super(ScalarNode, self).__init__(schema)
+        check_value = schema.check_value
+        inspect = schema.value_inspector()
+        self.check_column = schema.check_column
+        if schema.memo is not None:
+            check_value = partial(schema.memo.call, check_value, schema.origin)
+            inspect = partial(schema.memo.inspect, inspect, schema.origin)
+            self.check_column = None
+        if schema.hooks:
+            # hooks set errors of item results
+            self.check_column = None
+        self.check_value = check_value
+        self.inspect = inspect
+
+    def validate(self, raw, fail_fast=False):
+        if not self.required and not raw:
+            return Result(raw, absent=True)
+        value, error = self.inspect(raw)
+        if error is None:
+            return Result(value)
+        if fail_fast:
+            raise ValidationError(message_of(error))
+        return Result(self.default, error)
+
+    def check(self, raw, fail_fast=False):
+        return Result(self.check_value(raw))
+
+
+class InstanceNode(Node):
+    '''Fallback for validators with custom `check_data`, validated copy of
+    schema has the same interface as result.
+    '''
+    __slots__ = ('schema',)
+
+    def __init__(self, schema):
+        super(InstanceNode, self).__init__(schema)
+        self.schema = schema
+
+    def validate(self, raw, fail_fast=False):
+        instance = self.schema(raw, True)
+        if fail_fast:
+            for error in instance.itererrors():
+                raise ValidationError(error)
+        return instance
+
+
+class TupleNode(Node):
+    __slots__ = ('nodes', 'length_error')
+
+    def __init__(self, schema):
+        super(TupleNode, self).__init__(schema)
+        self.nodes = tuple(node_for(typ) for typ in schema.types)
+        self.length_error = Error('length', 'Must be iterable of length %i',
+                                  (len(self.nodes),))
+
+    def absent(self, raw):
+        return TupleResult(absent=True)
+
+    def failed(self, error):
+        return TupleResult(error=error)
+
+    def check(self, raw, fail_fast=False):
+        if not isinstance(raw, Iterable):
+            return self.reject(NOT_ITERABLE, fail_fast)
+        raw = tuple(raw)
+        if len(self.nodes) != len(raw):
+            return self.reject(self.length_error, fail_fast)
+        if fail_fast:
+            return TupleResult([validate_child(node, index, value)
+                                for index, (node, value)
+                                in enumerate(zip(self.nodes, raw))])
+        return TupleResult([node.validate(value) for node, value
+                            in zip(self.nodes, raw)])
+
+    def revalidate(self, result, tree):
+        if '' in tree or result.children is None:
+            return Node.revalidate(self, result, tree)
+        children = list(result.children)
+        for key, child in tree.iteritems():
+            if key.isdigit() and int(key) < len(children):
+                number = int(key)
+                children[number] = self.nodes[number].revalidate(
+                    children[number], child)
+        return TupleResult(children)
+
+
+class ListNode(Node):
+    '''Lists of required scalars are checked at once by `check_column` of
+    scalar, if it can, and only failed items are validated one by one.
+    '''
+    __slots__ = ('node', 'column', 'max_length', 'length_error')
+
+    def __init__(self, schema):
+        super(ListNode, self).__init__(schema)
+        self.node = node_for(schema.type)
+        self.max_length = schema.max_length
+        self.length_error = None
+        if self.max_length is not None:
+            self.length_error = Error('max_length',
+                                      'Must have at most %i items',
+                                      (self.max_length,))
+        self.column = None
+        if isinstance(self.node, ScalarNode) and self.node.required:
+            self.column = self.node.check_column
+
+    def absent(self, raw):
+        return ListResult(absent=True)
+
+    def failed(self, error):
+        return ListResult(error=error)
+
+    def check(self, raw, fail_fast=False):
+        if not isinstance(raw, Iterable):
+            return self.reject(NOT_ITERABLE, fail_fast)
+        if self.max_length is not None:
+            raw = take(raw, self.max_length)
+            if raw is None:
+                return self.reject(self.length_error, fail_fast)
+        checked = self.column(raw) if self.column is not None else None
+        if checked is not None:
+            values, failed = checked
+            node = self.node
+            if fail_fast:
+                for index in failed:
+                    validate_child(node, index, raw[index])
+            return ArrayResult(values, dict((index, node.validate(raw[index]))
+                                            for index in failed))
+        if fail_fast:
+            node = self.node
+            return ListResult([validate_child(node, index, value)
+                               for index, value in enumerate(raw)])
+        validate = self.node.validate
+        return ListResult([validate(value) for value in raw])
+
+    def revalidate(self, result, tree):
+        if '' in tree or result.children is None:
+            return Node.revalidate(self, result, tree)
+        if isinstance(result, ArrayResult):
+            return self.revalidate_array(result, tree)
+        node = self.node
+        children = list(result.children)
+        for number, child in sorted((int(key), child) for key, child
+                                    in tree.iteritems() if key.isdigit()):
+            if number < len(children):
+                children[number] = node.revalidate(children[number], child)
+            else:
+                children.append(node.validate(merge_tree(None, child)))
+        if self.max_length is not None and len(children) > self.max_length:
+            return self.failed(self.length_error)
+        return ListResult(children)
+
+    def revalidate_array(self, result, tree):
+        '''Changed items are put into copies of values and failures of
+        array, results are not made for other items
+        '''
+        node = self.node
+        values, failures = list(result.values), dict(result.failures)
+        for number, child in sorted((int(key), child) for key, child
+                                    in tree.iteritems() if key.isdigit()):
+            if number < len(values):
+                previous = failures.get(number)
+                if previous is None:
+                    previous = Result(values[number])
+                changed = node.revalidate(previous, child)
+            else:
+                changed = node.validate(merge_tree(None, child))
+                number = len(values)
+                values.append(None)
+            if changed.error:
+                failures[number] = changed
+            else:
+                values[number] = changed.data
+                failures.pop(number, None)
+        if self.max_length is not None and len(values) > self.max_length:
+            return self.failed(self.length_error)
+        return ArrayResult(values, failures)
+
+
+class DictNode(Node):
+    __slots__ = ('names', 'nodes', 'positions')
+
+    def __init__(self, schema):
+        super(DictNode, self).__init__(schema)
+        self.names = tuple(schema.named_types)
+        self.nodes = tuple(node_for(schema.named_types[name])
+                           for name in self.names)
+        self.positions = dict((name, position) for position, name
+                              in enumerate(self.names))
+
+    def absent(self, raw):
+        return DictResult(self.names, absent=True)
+
+    def failed(self, error):
+        return DictResult(self.names, error=error)
+
+    def check(self, raw, fail_fast=False):
+        if not isinstance(raw, dict):
+            return self.reject(NOT_DICT, fail_fast)
+        get = raw.get
+        if fail_fast:
+            children = [validate_child(node, name, get(name))
+                        for name, node in zip(self.names, self.nodes)]
+            return DictResult(self.names, children)
+        return DictResult(self.names, [node.validate(get(name)) for name, node
+                                       in zip(self.names, self.nodes)])
+
+    def validate_partial(self, raw, fields=None, fail_fast=False):
+        '''Validate `fields`, or known keys of raw dict, in order of names
+        '''
+        if not isinstance(raw, dict):
+            return self.reject(NOT_DICT, fail_fast)
+        positions = self.positions
+        if fields is None:
+            fields = raw
+        selected = sorted(positions[name] for name in fields
+                          if name in positions)
+        names = tuple(self.names[position] for position in selected)
+        nodes = [self.nodes[position] for position in selected]
+        get = raw.get
+        if fail_fast:
+            return DictResult(names, [validate_child(node, name, get(name))
+                                      for name, node in zip(names, nodes)])
+        return DictResult(names, [node.validate(get(name)) for name, node
+                                  in zip(names, nodes)])
+
+    def revalidate(self, result, tree):
+        if '' in tree or result.children is None:
+            return Node.revalidate(self, result, tree)
+        names, children = result.names, list(result.children)
+        positions = self.positions
+        if names is not self.names:
+            # sparse or merged result, absent fields are added after others
+            positions = dict((name, position) for position, name
+                             in enumerate(names))
+        for name, child in tree.iteritems():
+            index = self.positions.get(name)
+            if index is None:
+                continue
+            node, position = self.nodes[index], positions.get(name)
+            if position is None:
+                names += (name,)
+                children.append(node.validate(merge_tree(None, child)))
+            else:
+                children[position] = node.revalidate(children[position],
+                                                     child)
+        return DictResult(names, children)
+
+
+class UnionNode(Node):
+    '''Types are tried in order for kind of value, see `validators.Union`,
+    with fail fast validation, so failed type costs only its first error.
+    '''
+    __slots__ = ('nodes', 'indexes', 'orders', 'exclusive', 'error')
+
+    def __init__(self, schema):
+        super(UnionNode, self).__init__(schema)
+        self.nodes = tuple(node_for(typ) for typ in schema.types)
+        self.indexes = schema.orders
+        self.arrange()
+        self.exclusive = schema.exclusive
+        if self.exclusive:
+            self.error = Error('one_of',
+                               'Must match exactly one of %i schemas',
+                               (len(self.nodes),))
+        else:
+            self.error = Error('union', 'Must match one of %i schemas',
+                               (len(self.nodes),))
+
+    def arrange(self):
+        self.orders = dict((kind, tuple(self.nodes[index] for index in order))
+                           for kind, order in self.indexes.iteritems())
+
+    def index_of(self, data):
+        '''Return index of type, that validated data of union was chosen by,
+        or None
+        '''
+        for index in self.indexes[kind_of(data)]:
+            try:
+                self.nodes[index].validate(data, True)
+            except ValidationError:
+                continue
+            return index
+        return None
+
+    def check(self, raw, fail_fast=False):
+        # value is counted by union, budget forgets failed variants
+        budget = budgets.current() if budgets.running else None
+        chosen = None
+        kind = kind_of(raw)
+        for index, node in izip(self.indexes[kind], self.orders[kind]):
+            if budget is not None:
+                mark = budget.attempt(raw)
+            try:
+                result = node.validate(raw, True)
+            except ValidationError:
+                result = None
+            if budget is not None:
+                budget.attempted(mark, result is None)
+            if result is None:
+                continue
+            if not self.exclusive:
+                return choose(result, index)
+            if chosen is not None:
+                return self.reject(self.error, fail_fast)
+            chosen, chosen_index = result, index
+        if chosen is None:
+            return self.reject(self.error, fail_fast)
+        return choose(chosen, chosen_index)
+
+
+def choose(result, index):
+    '''Record index of chosen type on result, before indexes of nested
+    unions, so hooks and renderer do not validate data again
+    '''
+    result.chosen = (index,) + getattr(result, 'chosen', ())
+    return result
+
+
+class TaggedNode(Node):
+    '''Variant is looked up by tag in dict, see `validators.Tagged`
+    '''
+    __slots__ = ('key', 'variants', 'names', 'error')
+
+    def __init__(self, schema):
+        super(TaggedNode, self).__init__(schema)
+        self.key = schema.key
+        self.variants = {}
+        # names of results with tag, None if variant has field for tag
+        self.names = {}
+        for tag, typ in schema.variants.iteritems():
+            node = self.variants[tag] = node_for(typ)
+            if isinstance(node, DictNode) and self.key not in node.positions:
+                self.names[tag] = (self.key,) + node.names
+            else:
+                self.names[tag] = None
+        self.error = Error('tag', 'Value of %s must be one of: %s',
+                           (self.key, ', '.join(map(unicode,
+                                                    sorted(self.variants)))))
+
+    def check(self, raw, fail_fast=False):
+        if not isinstance(raw, dict):
+            return self.reject(NOT_DICT, fail_fast)
+        tag = raw.get(self.key)
+        try:
+            node = self.variants.get(tag)
+        except TypeError: # unhashable
+            node = None
+        if node is None:
+            return self.reject(self.error, fail_fast)
+        budget = budgets.current() if budgets.running else None
+        if budget is None:
+            result = node.validate(raw, fail_fast)
+        else:
+            # value is counted by tagged node
+            mark = budget.attempt(raw)
+            try:
+                result = node.validate(raw, fail_fast)
+            finally:
+                budget.attempted(mark, False)
+        names = self.names[tag]
+        if names is None or result.children is None:
+            return result
+        return DictResult(names, [Result(tag)] + result.children)
@@ -0,0 +1,159 @@
+# (c) Svarga project under terms of the new BSD license
+'''Profiling of validation
+
+    >>> with profiling.Profiler() as profiler:
+    ...     form = Form(data)
+    >>> profiler.as_dict()['pets.*.name']
+    {'calls': 3, 'cumulative': 0.0001, 'self': 0.0001, 'errors': 1}
+
+Calls, cumulative and self time and errors are counted for every schema
+path, items of lists share `*` path. Both validators and compiled plans are
+profiled. Profiler is process wide, validations in other threads are
+profiled too, each thread has own stack of frames. When no profiler is
+active validation pays only for one check of `active`, or of
+`utils.instrumented` for validators.
+'''
+
+from threading import local, Lock
+from timeit import default_timer
+from procrustes import utils
+
+
+active = None
+
+
+def join(path):
+    return '.'.join(path)
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = Lock()
+        # stacks of frames by thread, frame is [time spent in children,
+        # records of validated children]
+        self.local = local()
+        self.previous = None
+
+    @property
+    def frames(self):
+        frames = getattr(self.local, 'frames', None)
+        if frames is None:
+            frames = self.local.frames = []
+        return frames
+
+    def __enter__(self):
+        global active
+        self.previous = active
+        active = self
+        utils.instrument(1)
+        return self
+
+    def __exit__(self, *exc_info):
+        global active
+        active = self.previous
+        self.previous = None
+        utils.instrument(-1)
+
+    def record(self, path, stat):
+        with self.lock:
+            total = self.stats.get(path)
+            if total is None:
+                self.stats[path] = list(stat)
+                return
+            for i, value in enumerate(stat):
+                total[i] += value
+
+    # Compiled plans, path of node is known
+    def start(self):
+        self.frames.append([0.0, []])
+        return default_timer()
+
+    def stop(self, path, start, failed):
+        elapsed = default_timer() - start
+        frames = self.frames
+        frame = frames.pop()
+        if frames:
+            frames[-1][0] += elapsed
+        self.record(path, [1, elapsed, elapsed - frame[0], int(failed)])
+        # validators, called by fallback node
+        for instance, records in frame[1]:
+            for subpath, stat in records.iteritems():
+                if subpath:
+                    self.record(join((path,) + subpath).lstrip('.'), stat)
+
+    # Validators, path is known only when parent has its data validated
+    def validate(self, instance, safe=False):
+        frame = [0.0, []]
+        frames = self.frames
+        frames.append(frame)
+        start = default_timer()
+        try:
+            return instance.validate_raw(safe)
+        finally:
+            elapsed = default_timer() - start
+            frames.pop()
+            records = self.collect(instance, elapsed, frame)
+            if frames:
+                frames[-1][0] += elapsed
+                frames[-1][1].append((instance, records))
+            else:
+                for path, stat in records.iteritems():
+                    self.record(join(path), stat)
+
+    def collect(self, instance, elapsed, frame):
+        '''Merge records of children into records of instance, relative
+        paths are keys of records.
+        '''
+        records = {(): [1, elapsed, elapsed - frame[0],
+                        int(bool(instance.error))]}
+        if not frame[1]:
+            return records
+        merged = instance.path_merged
+        if not merged:
+            wildcard = instance.path_wildcard
+            keys = dict((id(child), '*' if wildcard else key)
+                        for key, child in instance.flat_items() or ())
+        for child, child_records in frame[1]:
+            if merged:
+                # types of union are recorded at its path, as by plans,
+                # type fails with any error of its subtree
+                prefix = ()
+                child_records[()][3] = int(any(child.itererrors()))
+            else:
+                prefix = (keys.get(id(child), '?'),)
+            for path, stat in child_records.iteritems():
+                path = prefix + path
+                total = records.get(path)
+                if total is None:
+                    records[path] = stat
+                    continue
+                for i, value in enumerate(stat):
+                    total[i] += value
+        return records
+
+    # Export
+    def as_dict(self):
+        return dict((path, {'calls': calls, 'cumulative': cumulative,
+                            'self': own, 'errors': errors})
+                    for path, (calls, cumulative, own, errors)
+                    in self.stats.iteritems())
+
+    def prometheus(self, prefix='procrustes_validation'):
+        '''Return stats in Prometheus text exposition format'''
+        metrics = [('calls_total', 'Validations of schema path', 0),
+                   ('seconds_total', 'Cumulative validation time', 1),
+                   ('self_seconds_total', 'Validation time without children',
+                    2),
+                   ('errors_total', 'Failed validations of schema path', 3)]
+        lines = []
+        for name, help, index in metrics:
+            name = '%s_%s' % (prefix, name)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for path in sorted(self.stats):
+                label = path.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('%s{path="%s"} %r'
+                             % (name, label, self.stats[path][index]))
+        return '\n'.join(lines) + '\n'
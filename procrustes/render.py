@@ -0,0 +1,333 @@
+# (c) Svarga project under terms of the new BSD license
+'''Rendering of whole forms
+
+Renderer compiles markup of every field widget, together with row layout,
+into one format string once per schema. Form is rendered in one pass,
+without widget objects:
+
+    >>> renderer = render.Renderer(Form)
+    >>> html = renderer.render(form)
+
+Layout is set by `row`, `place`, `start` and `stop` attributes, subclass
+renderer to change them. Templates of list rows do not depend on data, their
+markup is rendered once per `(id, parent)` by `render_templates`.
+'''
+
+import re
+from cgi import escape
+from string import Formatter
+from procrustes import forms, plan
+from procrustes.errors import message_of
+from procrustes.results import Result
+from procrustes.utils import schema_of
+
+
+# Placeholders, widgets are rendered with them once to get template
+SENTINELS = {u'\x00name\x00': u'name', u'\x00parent\x00': u'parent',
+             u'\x00data\x00': u'data', u'\x00id\x00': u'id'}
+sentinels_re = re.compile(u'(%s)' % u'|'.join(SENTINELS))
+
+
+def to_format(markup):
+    '''Turn markup, rendered with sentinels, to format string'''
+    parts = sentinels_re.split(markup)
+    for i, part in enumerate(parts):
+        if i % 2:
+            parts[i] = u'{%s}' % SENTINELS[part]
+        else:
+            parts[i] = part.replace(u'{', u'{{').replace(u'}', u'}}')
+    return u''.join(parts)
+
+
+def compose(layout, **templates):
+    '''Put format strings of templates into fields of layout'''
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(layout):
+        parts.append(literal.replace(u'{', u'{{').replace(u'}', u'}}'))
+        if field is None:
+            continue
+        if field in templates:
+            parts.append(templates[field])
+        else:
+            parts.append(u'{%s}' % field)
+    return u''.join(parts)
+
+
+class Renderer(object):
+    row = (u'<div class="form_row">'
+           u'<span class="form_label">{label}</span>'
+           u'<span class="form_input">{input}</span>'
+           u'<span class="form_error">{error}</span></div>\n')
+    place = (u'<p id="add__{parent_label}">Add one {label_name}</p>\n'
+             u'<div id="placeholder__{parent_label}"'
+             u' class="procrustes__placeholder"></div>\n')
+    start = u'<div>\n'
+    stop = u'<span class="form_delete">Delete</span>\n</div>\n'
+    template_start = (u'<div id="template__{parent_label}"'
+                      u' class="procrustes_template pt__{name}">\n')
+    template_row = (u'<div class="procrustes_template pt__{name}">'
+                    u'<span class="form_label">{label}</span>'
+                    u'<span class="form_input">{input}</span></div>\n')
+    template_stop = stop
+
+    def __init__(self, schema, delimiter='__'):
+        self.delimiter = delimiter
+        self.schema = schema_of(schema)
+        self.root = self.compile(schema)
+        self.templates = {}
+
+    def compile(self, typ):
+        schema = schema_of(typ)
+        if isinstance(schema, forms.List):
+            return ListRender(self, typ, schema)
+        if isinstance(schema, forms.Dict):
+            return ContainerRender(self, schema.named_types.iteritems())
+        if isinstance(schema, forms.Tuple):
+            return ContainerRender(self, ((str(number), typ) for number, typ
+                                          in enumerate(schema.types)))
+        if isinstance(schema, forms.Tagged):
+            return TaggedRender(self, schema)
+        if isinstance(schema, forms.Union):
+            return UnionRender(self, schema)
+        if isinstance(schema, forms.FieldMixin):
+            return FieldRender(self, schema)
+        return None
+
+    def iterrender(self, form=None, id='', parent=''):
+        '''Yield rendered pieces of validated form, result of plan or blank
+        form if `form` is None. Pieces are yielded by rows of lists.
+        '''
+        if self.root is None:
+            return iter(())
+        return self.root.iterrender(form, id, parent)
+
+    def render(self, form=None, id='', parent=''):
+        if self.root is None:
+            return u''
+        out = []
+        self.root.render(form, id, parent, out)
+        return u''.join(out)
+
+    def render_templates(self, id='', parent=''):
+        '''Markup of row templates of all lists in the form'''
+        key = (id, parent)
+        markup = self.templates.get(key)
+        if markup is not None:
+            return markup
+        out = []
+        template_widgets = getattr(self.schema, 'template_widgets', None)
+        if template_widgets is not None:
+            for widget in template_widgets(id, self.delimiter, parent):
+                if widget.marker == 'start':
+                    layout = self.template_start
+                elif widget.marker == 'stop':
+                    layout = self.template_stop
+                else:
+                    layout = self.template_row
+                out.append(layout.format(
+                    parent_label=widget.parent_label, name=widget.name,
+                    label=widget.label(), input=widget.render()))
+        markup = self.templates[key] = u''.join(out)
+        return markup
+
+    def render_to(self, stream, form=None, id='', parent='', encoding=None):
+        write = stream.write
+        for piece in self.iterrender(form, id, parent):
+            write(piece.encode(encoding) if encoding else piece)
+
+    def wsgi(self, form=None, id='', parent='', encoding='utf-8',
+             buffer_size=8192):
+        '''Iterable of encoded chunks, suitable for WSGI response'''
+        buffer, size = [], 0
+        for piece in self.iterrender(form, id, parent):
+            piece = piece.encode(encoding)
+            buffer.append(piece)
+            size += len(piece)
+            if size >= buffer_size:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+
+
+class FieldRender(object):
+    __slots__ = ('prefix', 'full', 'empty')
+
+    def __init__(self, renderer, schema):
+        widget = schema.widget(data=u'\x00data\x00', id=u'\x00id\x00',
+                               error=None, parent=u'\x00parent\x00',
+                               label_name=schema.field_name,
+                               **schema.widget_kwargs)
+        self.prefix = widget.prefix
+        widget.name = u'\x00name\x00'
+        label = to_format(widget.label())
+        self.full = compose(renderer.row, label=label,
+                            input=to_format(widget.render()))
+        widget.data = None
+        self.empty = compose(renderer.row, label=label,
+                             input=to_format(widget.render()))
+
+    def render(self, value, id, parent, out):
+        if value is None:
+            data = error = None
+        else:
+            data, error = value.data, message_of(value.error)
+        template = self.full if data else self.empty
+        name = self.prefix + u'__' + id if id else self.prefix
+        out.append(template.format(name=name, id=id, parent=parent, data=data,
+                                   error=escape(error, True) if error
+                                   else u''))
+
+    def iterrender(self, value, id, parent):
+        out = []
+        self.render(value, id, parent, out)
+        return out
+
+
+class ContainerRender(object):
+    __slots__ = ('delimiter', 'children')
+
+    def __init__(self, renderer, children):
+        self.delimiter = renderer.delimiter
+        self.children = []
+        for key, typ in children:
+            node = renderer.compile(typ)
+            if node is not None:
+                self.children.append((key, node))
+
+    def items(self, value, id):
+        prefix = id + self.delimiter if id else ''
+        items = dict(value.flat_items() or ()) if value is not None else {}
+        for key, node in self.children:
+            yield node, items.get(key), prefix + key
+
+    def render(self, value, id, parent, out):
+        for node, child, child_id in self.items(value, id):
+            node.render(child, child_id, parent, out)
+
+    def iterrender(self, value, id, parent):
+        for node, child, child_id in self.items(value, id):
+            for piece in node.iterrender(child, child_id, parent):
+                yield piece
+
+
+class ListRender(object):
+    __slots__ = ('delimiter', 'node', 'label_name', 'place', 'start', 'stop')
+
+    def __init__(self, renderer, typ, schema):
+        self.delimiter = renderer.delimiter
+        self.node = renderer.compile(schema.type)
+        self.label_name = getattr(schema.type, 'field_name', None)
+        self.place = renderer.place
+        self.start = renderer.start
+        self.stop = renderer.stop
+
+    def place_html(self, id, parent):
+        label_name = self.label_name
+        if label_name is None:
+            label_name = id + self.delimiter if id else ''
+        return self.place.format(
+            parent_label=u'form' + self.delimiter + parent + id,
+            label_name=escape(label_name, True))
+
+    def rows(self, value, id):
+        prefix = id + self.delimiter if id else ''
+        items = list(value.flat_items() or ()) if value is not None else []
+        if not items:
+            return [(None, prefix + '0')]
+        return [(child, prefix + str(number))
+                for number, (key, child) in enumerate(items)]
+
+    def render(self, value, id, parent, out):
+        out.append(self.place_html(id, parent))
+        node = self.node
+        for child, child_id in self.rows(value, id):
+            out.append(self.start)
+            if node is not None:
+                node.render(child, child_id, parent, out)
+            out.append(self.stop)
+
+    def iterrender(self, value, id, parent):
+        yield self.place_html(id, parent)
+        node = self.node
+        for child, child_id in self.rows(value, id):
+            out = [self.start]
+            if node is not None:
+                node.render(child, child_id, parent, out)
+            out.append(self.stop)
+            yield u''.join(out)
+
+
+class UnionRender(object):
+    '''Value is rendered by type, that is valid for its data, blank form by
+    first type
+    '''
+    __slots__ = ('nodes', 'union')
+
+    def __init__(self, renderer, schema):
+        self.nodes = [renderer.compile(typ) for typ in schema.types]
+        self.union = plan.UnionNode(schema)
+
+    def node_for(self, value, chosen=None):
+        '''Return node of chosen type, `chosen` are indexes of types of this
+        and nested unions, by default they are taken from value
+        '''
+        if value is None or value.data is None:
+            return self.nodes[0]
+        if chosen is None:
+            chosen = getattr(value, 'chosen', ())
+        node = self
+        while isinstance(node, UnionRender):
+            if chosen:
+                index, chosen = chosen[0], chosen[1:]
+            else:
+                index = node.union.index_of(value.data)
+            node = node.nodes[index if index is not None else 0]
+        return node
+
+    def render(self, value, id, parent, out):
+        node = self.node_for(value)
+        if node is not None:
+            node.render(value, id, parent, out)
+
+    def iterrender(self, value, id, parent):
+        out = []
+        self.render(value, id, parent, out)
+        return out
+
+
+class TaggedRender(object):
+    '''Tag is rendered by widget of tagged field, if variant has no field
+    for it, and is followed by fields of variant
+    '''
+    __slots__ = ('delimiter', 'key', 'tag', 'first', 'variants')
+
+    def __init__(self, renderer, schema):
+        self.delimiter = renderer.delimiter
+        self.key = schema.key
+        self.tag = FieldRender(renderer, schema)
+        self.first = sorted(schema.variants)[0]
+        self.variants = {}
+        for tag, typ in schema.variants.iteritems():
+            declared = self.key in schema_of(typ).named_types
+            self.variants[tag] = (renderer.compile(typ), declared)
+
+    def render(self, value, id, parent, out):
+        data = value.data if value is not None else None
+        tag = data.get(self.key) if isinstance(data, dict) else None
+        if tag not in self.variants:
+            tag = self.first
+        node, declared = self.variants[tag]
+        if not declared:
+            prefix = id + self.delimiter if id else ''
+            self.tag.render(Result(tag), prefix + self.key, parent, out)
+        if isinstance(node, UnionRender):
+            # indexes of value are of unions, that contain tagged one
+            node = node.node_for(value, ())
+        if node is not None:
+            node.render(value, id, parent, out)
+
+    def iterrender(self, value, id, parent):
+        out = []
+        self.render(value, id, parent, out)
+        return out
@@ -0,0 +1,242 @@
+# (c) Svarga project under terms of the new BSD license
+'''Validation results
+
+Results are returned by compiled plans. Result holds only validated value,
+error and child results, schema is shared between all results and is never
+copied.
+'''
+
+from procrustes.errors import Error, message_of
+from procrustes.utils import iterflatten
+
+
+def iterdetails(value, path=()):
+    '''Yield errors of result, or of validated value, as `errors.Error`
+    with path of flat keys to invalid value
+    '''
+    error = value.error
+    if error:
+        if isinstance(error, Error):
+            yield error.at(path)
+        else:
+            yield Error(None, error, (), path)
+    for key, child in value.flat_items() or ():
+        for error in iterdetails(child, path + (key,)):
+            yield error
+
+
+class Result(object):
+    # `chosen` is set only on results of unions, see `plan.UnionNode`
+    __slots__ = ('value', 'error', 'absent', 'chosen')
+
+    def __init__(self, value=None, error=None, absent=False):
+        self.value = value
+        self.error = error
+        self.absent = absent
+
+    def __reduce__(self):
+        return type(self), (self.value, self.error, self.absent)
+
+    @property
+    def data(self):
+        return self.value
+
+    @property
+    def errors(self):
+        return list(self.itererrors())
+
+    def itererrors(self):
+        if self.error:
+            yield message_of(self.error)
+
+    @property
+    def details(self):
+        '''Structured errors, see `iterdetails`'''
+        return list(iterdetails(self))
+
+    def flatten(self, delimiter='__'):
+        return iterflatten(self, delimiter)
+
+    def flat_items(self):
+        return None
+
+    def fail(self, error, default=None):
+        '''Turn valid result into failed one, as plan makes for invalid
+        value, i.e. when hook rejects value
+        '''
+        self.value = default
+        self.error = error
+
+
+class ContainerResult(Result):
+    '''Errors of container are collected once, results made by
+    `Plan.revalidate` share children and their collected errors.
+    '''
+    __slots__ = ('children', 'collected')
+
+    def __init__(self, children=None, error=None, absent=False):
+        super(ContainerResult, self).__init__(None, error, absent)
+        self.children = children
+        self.collected = None
+
+    def __reduce__(self):
+        return type(self), (self.children, self.error, self.absent)
+
+    def itererrors(self):
+        if self.collected is None:
+            errors = [message_of(self.error)] if self.error else []
+            for child in self.children or ():
+                errors.extend(child.itererrors())
+            self.collected = errors
+        return iter(self.collected)
+
+    def flat_items(self):
+        if not self.children:
+            return ()
+        return ((str(number), child) for number, child
+                in enumerate(self.children))
+
+    def fail(self, error, default=None):
+        self.children = None
+        self.collected = None
+        self.error = error
+
+
+class ListResult(ContainerResult):
+    __slots__ = ()
+
+    @property
+    def data(self):
+        if not self.children:
+            return
+        return [child.data for child in self.children]
+
+
+class ArrayResult(ListResult):
+    '''Result of list of scalars, that were checked at once
+
+    Validated values are kept in list, results are kept only for failed
+    items and are made on demand for others.
+    '''
+    __slots__ = ('values', 'failures')
+
+    def __init__(self, values=(), failures=None):
+        Result.__init__(self)
+        self.collected = None
+        self.values = values
+        self.failures = failures or {}
+
+    @property
+    def children(self):
+        return [child for key, child in self.flat_items()]
+
+    def __reduce__(self):
+        return ArrayResult, (self.values, self.failures)
+
+    @property
+    def data(self):
+        if not self.values:
+            return
+        data = list(self.values)
+        for index, result in self.failures.iteritems():
+            data[index] = result.data
+        return data
+
+    def itererrors(self):
+        if self.collected is None:
+            failures = self.failures
+            errors = [message_of(self.error)] if self.error else []
+            errors.extend(error for index in sorted(failures)
+                          for error in failures[index].itererrors())
+            self.collected = errors
+        return iter(self.collected)
+
+    def fail(self, error, default=None):
+        self.values = ()
+        self.failures = {}
+        self.collected = None
+        self.error = error
+
+    def flat_items(self):
+        failures = self.failures
+        return ((str(index), failures[index] if index in failures
+                 else Result(value))
+                for index, value in enumerate(self.values))
+
+
+class TupleResult(ContainerResult):
+    __slots__ = ()
+
+    @property
+    def data(self):
+        if not self.children:
+            return
+        return tuple(child.data for child in self.children)
+
+
+class DictResult(ContainerResult):
+    '''Children are kept in list, names are shared with plan node'''
+    __slots__ = ('names',)
+
+    def __init__(self, names=(), children=None, error=None, absent=False):
+        super(DictResult, self).__init__(children, error, absent)
+        self.names = names
+
+    def __reduce__(self):
+        return DictResult, (self.names, self.children, self.error,
+                            self.absent)
+
+    def __getitem__(self, name):
+        if not self.children:
+            raise KeyError(name)
+        return self.children[self.names.index(name)]
+
+    def iteritems(self):
+        if not self.children:
+            return iter(())
+        return iter(zip(self.names, self.children))
+
+    flat_items = iteritems
+
+    def merge(self, partial):
+        '''Return result with children of sparse `partial` result put over
+        children of this one, neither result is changed
+        '''
+        names, children = list(self.names), list(self.children or ())
+        if not children:
+            names = []
+        positions = dict((name, position) for position, name
+                         in enumerate(names))
+        for name, child in partial.iteritems():
+            position = positions.get(name)
+            if position is None:
+                names.append(name)
+                children.append(child)
+            else:
+                children[position] = child
+        names = tuple(names)
+        if names == self.names:
+            # keep names shared with plan node
+            names = self.names
+        return DictResult(names, children, partial.error or self.error)
+
+    @property
+    def data(self):
+        if not self.children:
+            return
+        return dict((name, child.data) for name, child
+                    in zip(self.names, self.children))
+
+
+class FailedResult(Result):
+    '''First error of fail fast validation, `path` is a tuple of keys and
+    indexes leading to invalid value.
+    '''
+    __slots__ = ('path',)
+
+    def __init__(self, error, path=()):
+        super(FailedResult, self).__init__(None, error)
+        self.path = path
+
+    def __reduce__(self):
+        return FailedResult, (self.error, self.path)
@@ -0,0 +1,321 @@
+# (c) Svarga project under terms of the new BSD license
+'''Serialization of results, specialized for schema
+
+    >>> from procrustes import serialize
+    >>> serializer = serialize.Serializer(schema)
+    >>> serializer.dumps(plan(data))
+    '{"name":"ann","tags":["a","b"]}'
+    >>> serializer.flatten(plan(data))
+    {'name': 'ann', 'tags__0': 'a', 'tags__1': 'b'}
+
+Python source of writers is generated for a schema tree, as validation
+function of `codegen`. Results are written right away, without building
+`data` of containers. Valid values of `String`, `Integer` and `Boolean` are
+encoded without checks of their type, `Dict` keys are encoded once. Output
+is the same as of `json.dumps(result.data, separators=(',', ':'))` and of
+`dict(result.flatten())`, except for order of keys.
+
+Results of types, that can not be known from schema, as of unions or of
+custom validators, and validated instances of schema are serialized by
+their `data` and `flatten`.
+'''
+
+import json
+from json.encoder import encode_basestring_ascii
+from procrustes import codegen, plan, validators
+from procrustes.results import Result, ArrayResult
+from procrustes.utils import schema_of, iterflatten
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def put_flat(out, key, result, delimiter):
+    '''Flatten result of unknown type into `out` under `key`'''
+    for child_key, value in iterflatten(result, delimiter):
+        if not key:
+            out[child_key] = value
+        elif child_key:
+            out[key + delimiter + child_key] = value
+        else:
+            out[key] = value
+
+
+def scalar_type(node):
+    '''Return `String`, `Integer` or `Boolean`, if values of node are
+    checked by their checks, see `validators.own_checks`
+    '''
+    schema = getattr(node.check_value, 'im_self', None)
+    if schema is None:
+        return None
+    for typ in (validators.String, validators.Integer, validators.Boolean):
+        if validators.own_checks(schema, typ):
+            return typ
+    return None
+
+
+class Serializer(object):
+
+    def __init__(self, schema, delimiter='__'):
+        self.schema = schema_of(schema)
+        self.delimiter = delimiter
+        node = plan.node_for(self.schema)
+        self.write_json = JSONGenerator().build(node)
+        self.write_flat = FlatGenerator(delimiter).build(node)
+
+    def dumps(self, result):
+        '''Return JSON of result as `str`'''
+        out = []
+        self.write_json(result, out.append)
+        return ''.join(out)
+
+    def dump(self, result, stream):
+        '''Write JSON of result to stream'''
+        stream.write(self.dumps(result))
+
+    def flatten(self, result):
+        '''Return flat dict of result, as made by `flatten`'''
+        out = {}
+        self.write_flat(result, out)
+        return out
+
+
+def source(schema, delimiter='__'):
+    '''Return source of generated writers, for debugging
+    '''
+    node = plan.node_for(schema_of(schema))
+    lines = []
+    for generator in (JSONGenerator(), FlatGenerator(delimiter)):
+        generator.build(node)
+        lines.extend(generator.lines)
+    return '\n'.join(lines)
+
+
+class JSONGenerator(codegen.Generator):
+    '''Generates `write_json(result, w)`, that writes pieces of JSON
+    '''
+
+    def __init__(self):
+        super(JSONGenerator, self).__init__()
+        self.namespace.update({'Result': Result, 'ArrayResult': ArrayResult,
+                               'dumps': dumps,
+                               'encode': encode_basestring_ascii})
+
+    def build(self, node):
+        self.line(0, 'def write_json(result, w):')
+        self.line(1, 'if not isinstance(result, Result):')
+        self.line(2, 'w(dumps(result.data))')
+        self.line(2, 'return')
+        self.emit(node, 'result', 1)
+        return self.compile_function('write_json')
+
+    def compile_function(self, name):
+        code = compile('\n'.join(self.lines), '<procrustes.serialize>', 'exec')
+        exec code in self.namespace
+        return self.namespace[name]
+
+    def emit(self, node, src, indent):
+        '''Emit code, that writes result in `src` variable'''
+        emitter = self.emitters.get(type(node))
+        if emitter is None:
+            self.line(indent, 'w(dumps(%s.data))' % src)
+            return
+        emitter(self, node, src, indent)
+
+    def emit_scalar(self, node, src, indent):
+        typ = scalar_type(node)
+        if typ is None:
+            self.line(indent, 'w(dumps(%s.value))' % src)
+            return
+        # failed and absent values are not checked
+        self.line(indent, 'if %s.error or %s.absent:' % (src, src))
+        self.line(indent + 1, 'w(dumps(%s.value))' % src)
+        self.line(indent, 'else:')
+        self.line(indent + 1, 'w(%s)' % self.encoder(typ, '%s.value' % src))
+
+    def encoder(self, typ, value):
+        '''Expression, that encodes valid value of scalar type'''
+        if typ is validators.String:
+            return 'encode(%s)' % value
+        if typ is validators.Integer:
+            return 'str(%s)' % value
+        return "'true' if %s else 'false'" % value
+
+    def emit_dict(self, node, src, indent):
+        children = self.name('c')
+        self.line(indent, '%s = %s.children' % (children, src))
+        self.line(indent, 'if not %s:' % children)
+        self.line(indent + 1, "w('null')")
+        # sparse and tagged results have other names
+        self.line(indent, 'elif %s.names is not %s:'
+                  % (src, self.const(node.names)))
+        self.line(indent + 1, 'w(dumps(%s.data))' % src)
+        self.line(indent, 'else:')
+        separator = '{'
+        for position, (name, child) in enumerate(zip(node.names,
+                                                     node.nodes)):
+            self.line(indent + 1, 'w(%r)' % (
+                separator + encode_basestring_ascii(name) + ':'))
+            result = self.name('r')
+            self.line(indent + 1, '%s = %s[%i]' % (result, children, position))
+            self.emit(child, result, indent + 1)
+            separator = ','
+        self.line(indent + 1, "w('}')")
+
+    def emit_items(self, node, children, indent):
+        number, result = self.name('n'), self.name('r')
+        self.line(indent, "w('[')")
+        self.line(indent, 'for %s, %s in enumerate(%s):'
+                  % (number, result, children))
+        self.line(indent + 1, 'if %s:' % number)
+        self.line(indent + 2, "w(',')")
+        self.emit(node, result, indent + 1)
+        self.line(indent, "w(']')")
+
+    def emit_list(self, node, src, indent):
+        typ = scalar_type(node.node) \
+            if isinstance(node.node, plan.ScalarNode) else None
+        if typ is not None and typ is not validators.Boolean:
+            # values of scalars, checked at once, are valid
+            self.line(indent, 'if isinstance(%s, ArrayResult) and '
+                      'not %s.failures:' % (src, src))
+            self.line(indent + 1, "w('[%%s]' %% ','.join(map(%s, %s.values))"
+                      " if %s.values else 'null')"
+                      % ('encode' if typ is validators.String else 'str',
+                         src, src))
+            keyword = 'elif'
+        else:
+            keyword = 'if'
+        self.line(indent, '%s isinstance(%s, ArrayResult):' % (keyword, src))
+        self.line(indent + 1, 'w(dumps(%s.data))' % src)
+        children = self.name('c')
+        self.line(indent, 'else:')
+        self.line(indent + 1, '%s = %s.children' % (children, src))
+        self.line(indent + 1, 'if not %s:' % children)
+        self.line(indent + 2, "w('null')")
+        self.line(indent + 1, 'else:')
+        self.emit_items(node.node, children, indent + 2)
+
+    def emit_tuple(self, node, src, indent):
+        children = self.name('c')
+        self.line(indent, '%s = %s.children' % (children, src))
+        self.line(indent, 'if not %s:' % children)
+        self.line(indent + 1, "w('null')")
+        self.line(indent, 'else:')
+        separator = '['
+        for number, child in enumerate(node.nodes):
+            self.line(indent + 1, 'w(%r)' % separator)
+            result = self.name('r')
+            self.line(indent + 1, '%s = %s[%i]' % (result, children, number))
+            self.emit(child, result, indent + 1)
+            separator = ','
+        self.line(indent + 1, "w(']')")
+
+    emitters = {
+        plan.ScalarNode: emit_scalar,
+        plan.TupleNode: emit_tuple,
+        plan.ListNode: emit_list,
+        plan.DictNode: emit_dict,
+    }
+
+
+class FlatGenerator(JSONGenerator):
+    '''Generates `write_flat(result, out)`, that puts flat keys into dict
+
+    Key is kept as variable and literal suffix, so keys of nested `Dict`
+    and `Tuple` are joined when code is generated.
+    '''
+
+    def __init__(self, delimiter='__'):
+        super(FlatGenerator, self).__init__()
+        self.delimiter = delimiter
+        self.namespace.update({'put_flat': put_flat,
+                               'delimiter': delimiter})
+
+    def build(self, node):
+        self.line(0, 'def write_flat(result, out):')
+        self.line(1, 'if not isinstance(result, Result):')
+        self.line(2, "put_flat(out, '', result, delimiter)")
+        self.line(2, 'return')
+        self.emit(node, 'result', 1, (None, ''))
+        return self.compile_function('write_flat')
+
+    def key(self, key):
+        '''Expression of key'''
+        variable, suffix = key
+        if variable is None:
+            return repr(suffix)
+        if not suffix:
+            return variable
+        return '%s + %r' % (variable, suffix)
+
+    def child(self, key, name):
+        variable, suffix = key
+        if variable is None and not suffix:
+            return None, name
+        return variable, suffix + self.delimiter + name
+
+    def emit(self, node, src, indent, key):
+        emitter = self.emitters.get(type(node))
+        if emitter is None:
+            self.line(indent, 'put_flat(out, %s, %s, delimiter)'
+                      % (self.key(key), src))
+            return
+        emitter(self, node, src, indent, key)
+
+    def emit_scalar(self, node, src, indent, key):
+        self.line(indent, 'out[%s] = %s.value' % (self.key(key), src))
+
+    def emit_children(self, node, names, nodes, src, indent, key):
+        children = self.name('c')
+        self.line(indent, '%s = %s.children' % (children, src))
+        self.line(indent, 'if %s:' % children)
+        for position, (name, child) in enumerate(zip(names, nodes)):
+            result = self.name('r')
+            self.line(indent + 1, '%s = %s[%i]' % (result, children, position))
+            self.emit(child, result, indent + 1, self.child(key, name))
+        if not nodes:
+            self.line(indent + 1, 'pass')
+
+    def emit_dict(self, node, src, indent, key):
+        self.line(indent, 'if %s.names is not %s:'
+                  % (src, self.const(node.names)))
+        self.line(indent + 1, 'put_flat(out, %s, %s, delimiter)'
+                  % (self.key(key), src))
+        self.line(indent, 'else:')
+        self.emit_children(node, node.names, node.nodes, src, indent + 1, key)
+
+    def emit_tuple(self, node, src, indent, key):
+        self.emit_children(node, [str(number) for number
+                                  in xrange(len(node.nodes))],
+                           node.nodes, src, indent, key)
+
+    def emit_list(self, node, src, indent, key):
+        prefix = self.name('p')
+        self.line(indent, '%s = %s' % (prefix, self.key(
+            self.child(key, ''))))
+        number, value = self.name('n'), self.name('v')
+        self.line(indent, 'if isinstance(%s, ArrayResult):' % src)
+        self.line(indent + 1, 'if %s.failures:' % src)
+        self.line(indent + 2, 'put_flat(out, %s, %s, delimiter)'
+                  % (self.key(key), src))
+        self.line(indent + 1, 'else:')
+        self.line(indent + 2, 'for %s, %s in enumerate(%s.values):'
+                  % (number, value, src))
+        self.line(indent + 3, 'out[%s + str(%s)] = %s'
+                  % (prefix, number, value))
+        self.line(indent, 'else:')
+        number, result = self.name('n'), self.name('r')
+        self.line(indent + 1, 'for %s, %s in enumerate(%s.children or ()):'
+                  % (number, result, src))
+        item = self.name('k')
+        self.line(indent + 2, '%s = %s + str(%s)' % (item, prefix, number))
+        self.emit(node.node, result, indent + 2, (item, ''))
+
+    emitters = {
+        plan.ScalarNode: emit_scalar,
+        plan.TupleNode: emit_tuple,
+        plan.ListNode: emit_list,
+        plan.DictNode: emit_dict,
+    }
@@ -1,5 +1,25 @@
 # (c) Svarga project under terms of the new BSD license
 
+import re
+from collections import Iterable, Sized
+from itertools import islice
+from threading import Lock
+from ordereddict import OrderedDict
+from procrustes.errors import ValidationError, message_of
+
+
+# number of active budgets and profilers in all threads, so validators
+# check one flag, when validation is neither limited nor profiled
+instrumented = 0
+instrumented_lock = Lock()
+
+
+def instrument(step):
+    '''Count budget or profiler, that starts (1) or stops (-1)'''
+    global instrumented
+    with instrumented_lock:
+        instrumented += step
+
 
 def pop_prefixed_args(data, prefix):
     res = {}
@@ -8,3 +28,265 @@ def pop_prefixed_args(data, prefix):
             res[key[len(prefix):]] = data.pop(key)
     return res
 
+
+def iterflatten(value, delimiter='__'):
+    '''Flatten validated value, or result, to `(key, data)` pairs
+
+    Tree is walked without recursion and key is joined once for every leaf,
+    prefixes are not rebuilt on every nesting level.
+    '''
+    items = value.flat_items()
+    if items is None:
+        yield '', value.data
+        return
+    path = []
+    stack = [iter(items)]
+    while stack:
+        for key, child in stack[-1]:
+            items = child.flat_items()
+            path.append(key)
+            if items is None:
+                yield delimiter.join(path), child.data
+                path.pop()
+            else:
+                stack.append(iter(items))
+                break
+        else:
+            stack.pop()
+            if path:
+                path.pop()
+
+
+def flat_tree(flat, delimiter='__'):
+    '''Parse keys of flat dictionary into tree of nested dicts
+
+    Every key is split once, value is stored by empty key in the node of
+    its path, so `{'a__0': 1}` becomes `{'a': {'0': {'': 1}}}`.
+    '''
+    if flat is None:
+        return None
+    tree = {}
+    for key, value in flat.iteritems():
+        node = tree
+        for part in key.split(delimiter):
+            if part:
+                node = node.setdefault(part, {})
+        node[''] = value
+    return tree
+
+
+def take(iterable, limit):
+    '''Return items of iterable, or None if it has more than `limit` items
+
+    Sized iterable is returned as is, other is consumed to list of at most
+    `limit + 1` items.
+    '''
+    if not isinstance(iterable, Sized):
+        iterable = list(islice(iterable, limit + 1))
+    if len(iterable) > limit:
+        return None
+    return iterable
+
+
+def kind_of(value):
+    '''Kind of raw value, unions try types of the same kind first
+    '''
+    if isinstance(value, dict):
+        return 'dict'
+    if isinstance(value, Iterable) and not isinstance(value, basestring):
+        return 'sequence'
+    return 'scalar'
+
+
+def schema_of(typ):
+    '''Return validator instance for validator or `Declarative` class
+    '''
+    if not isinstance(typ, type):
+        return typ
+    schema = typ.__dict__.get('_schema_instance')
+    if schema is None:
+        schema = typ(None, False)
+        typ._schema_instance = schema
+    return schema
+
+
+def prototype_of(typ):
+    '''Return blank instance of validator or `Declarative` class
+
+    Prototype is built once and shared, so it is read-only. Call schema to
+    get blank instance, that may be changed.
+    '''
+    prototype = typ.__dict__.get('_prototype')
+    if prototype is None:
+        prototype = typ(None, False)
+        prototype.__class__ = frozen_class(type(prototype))
+        typ._prototype = prototype
+    return prototype
+
+
+# Read-only subclasses of validators, by validator class
+frozen_classes = {}
+
+
+def read_only(self, *args):
+    raise TypeError('Prototype of %s is read-only'
+                    % type(self).__mro__[1].__name__)
+
+
+def frozen_class(cls):
+    '''Return subclass, that forbids changes of attributes
+
+    Metaclass of `Declarative` is skipped, subclass keeps fields of class.
+    '''
+    frozen = frozen_classes.get(cls)
+    if frozen is None:
+        attrs = {'__module__': cls.__module__, '__setattr__': read_only,
+                 '__delattr__': read_only, '__call__': thawed_call}
+        frozen = frozen_classes[cls] = type.__new__(type(cls), cls.__name__,
+                                                    (cls,), attrs)
+    return frozen
+
+
+def thawed_call(self, *args, **kwargs):
+    '''Copies of prototype, called as schema, may be changed'''
+    return self.origin(*args, **kwargs)
+
+
+class PatternCache(object):
+    '''Bounded cache of compiled regular expressions
+
+    Least recently used pattern is dropped when cache is full.
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.patterns = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, regex, flags=0):
+        key = (regex, flags)
+        with self.lock:
+            pattern = self.patterns.pop(key, None)
+            if pattern is not None:
+                self.hits += 1
+                self.patterns[key] = pattern
+                return pattern
+            self.misses += 1
+        pattern = re.compile(regex, flags)
+        with self.lock:
+            self.patterns[key] = pattern
+            while len(self.patterns) > self.maxsize:
+                self.patterns.popitem(last=False)
+        return pattern
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.patterns), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self.lock:
+            self.patterns.clear()
+            self.hits = self.misses = 0
+
+
+patterns = PatternCache()
+
+
+class ValueCache(object):
+    '''Bounded cache of checks of scalar values
+
+    Value or error of `check(value)` is cached by owner of check and type and
+    value, so one cache may be shared by many validators. Unhashable values
+    are checked every time.
+
+    Entries are kept in two generations of plain dicts, hit in old
+    generation moves entry to recent one. When recent generation is full,
+    old one is evicted, so least recently used entries are dropped and hit
+    costs one dict lookup.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.generation = max(maxsize // 2, 1)
+        self.recent = {}
+        self.old = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unhashable = 0
+
+    def call(self, check, owner, value):
+        key = (owner, type(value), value)
+        try:
+            entry = self.recent.get(key)
+        except TypeError:
+            self.unhashable += 1
+            return check(value)
+        if entry is None:
+            entry = self.old.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                try:
+                    entry = (check(value), None)
+                except ValidationError as e:
+                    entry = (None, e.args[0])
+            else:
+                self.hits += 1
+            self.store(key, entry)
+        else:
+            self.hits += 1
+        if entry[1] is not None:
+            raise ValidationError(message_of(entry[1]))
+        return entry[0]
+
+    def inspect(self, inspect, owner, value):
+        '''Like `call`, but `inspect` and this method return
+        `(value, error)` instead of raising error
+        '''
+        key = (owner, type(value), value)
+        try:
+            entry = self.recent.get(key)
+        except TypeError:
+            self.unhashable += 1
+            return inspect(value)
+        if entry is None:
+            entry = self.old.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                entry = inspect(value)
+            else:
+                self.hits += 1
+            self.store(key, entry)
+        else:
+            self.hits += 1
+        return entry
+
+    def store(self, key, entry):
+        with self.lock:
+            self.recent[key] = entry
+            if len(self.recent) >= self.generation:
+                self.evictions += len(self.old)
+                self.old = self.recent
+                self.recent = {}
+
+    def __getstate__(self):
+        # copy of schema in other process starts with empty cache
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'unhashable': self.unhashable,
+                'size': len(self.recent) + len(self.old),
+                'maxsize': self.maxsize}
+
+    def clear(self):
+        with self.lock:
+            self.recent = {}
+            self.old = {}
+            self.hits = self.misses = self.evictions = self.unhashable = 0
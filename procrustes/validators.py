@@ -1,37 +1,142 @@
 # (c) Svarga project under terms of the new BSD license
 
-import re
+from array import array
 from collections import defaultdict, Iterable
+from functools import partial
+from itertools import chain
 from ordereddict import OrderedDict
+from procrustes import budgets, plan, profiling, results, utils
+from procrustes.utils import schema_of, prototype_of, flat_tree, kind_of
+from procrustes.errors import ValidationError, Error, LimitExceeded
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class schemamethod(object):
+    '''Method of schema, that is available on `Declarative` classes too
+
+    `Declarative` class is a schema itself, so on class access method is
+    bound to blank instance of the class.
+    '''
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None and isinstance(cls, DeclarativeMeta):
+            obj = schema_of(cls)
+        return self.func.__get__(obj, cls)
+
+
+# arguments of any schema, they are resolved once and shared by copies
+OPTIONS = frozenset(['memoize', 'hooks', 'limits'])
 
 
 class Base(object):
+    path_wildcard = False # all children share `*` key in profiling paths
+    path_merged = False # children are profiled at path of this validator
+    nested = False # level of depth in budget of limits
+    options = None # resolved `OPTIONS`, by attribute names
+    memo = None # cache of `check_value` results, `utils.ValueCache`
+    hooks = () # checks with I/O, see `hooks`
+    limits = None # `budgets.Limits` of validation, that starts with schema
 
     def __init__(self, *args, **kwargs):
         self.args = list(args)
         self.kwargs = kwargs.copy()
         self.configure(args, kwargs)
+        if not OPTIONS.isdisjoint(kwargs):
+            self.configure_options()
         self.absent = False # required and has data if False
-
-    def __call__(self, data=None, validate=True):
-        my_copy = type(self)(*list(self.args), **self.kwargs.copy())
-        my_copy.instantiate(data, validate)
+        self.origin = self # schema, this instance is built from
+
+    def __call__(self, data=None, validate=True, lazy=False, limits=None):
+        my_copy = type(self)(*self.args, **self.kwargs)
+        my_copy.origin = self.origin
+        if self.options is not None:
+            my_copy.__dict__.update(self.options)
+        if limits is None and self.limits is None:
+            my_copy.instantiate(data, validate, lazy)
+        else:
+            my_copy.instantiate_limited(data, validate, lazy, limits)
         return my_copy
 
-    def instantiate(self, data=None, validate=True):
+    def instantiate_limited(self, data, validate, lazy, limits):
+        '''Instantiate within budget of `limits`, or of schema limits, if
+        no budget is active
+
+        Lazy data is validated at once, budget does not outlive this call.
+        '''
+        if limits is None:
+            limits = self.limits
+        if limits is None or not validate or budgets.current() is not None:
+            return self.instantiate(data, validate, lazy)
+        with budgets.Budget(limits):
+            try:
+                self.instantiate(data, validate, lazy)
+                if lazy and isinstance(self, Container):
+                    self.force()
+            except LimitExceeded as e:
+                self.validated_data = self.default_data
+                self.error = e.error
+
+    def instantiate(self, data=None, validate=True, lazy=False):
+        '''Set data and validate it, `lazy` is used only by containers
+        '''
         self.raw_data = data
         self.validated_data = self.default_data
         self.error = None
-        if validate:
+        if not validate:
+            return
+        # budgets and profilers are checked by one flag
+        if utils.instrumented:
             self.validate(safe=True)
+        else:
+            self.validate_raw(safe=True)
 
     def configure(self, args, kwargs):
         self.default_data = None
         self.required = kwargs.pop('required', True)
 
+    def configure_options(self, **options):
+        '''Resolve `OPTIONS` of schema once, copies of schema get them from
+        `options` and do not resolve them again
+
+        `memoize` is size of cache or `utils.ValueCache`, keyword arguments
+        override options by attribute names.
+        '''
+        kwargs = self.kwargs
+        resolved = dict(self.options or ())
+        if 'memoize' in kwargs:
+            memo = kwargs.pop('memoize')
+            if memo is not None and not isinstance(memo, utils.ValueCache):
+                memo = utils.ValueCache(memo)
+            resolved['memo'] = memo
+        if 'hooks' in kwargs:
+            resolved['hooks'] = tuple(kwargs.pop('hooks'))
+        if 'limits' in kwargs:
+            resolved['limits'] = kwargs.pop('limits')
+        resolved.update(options)
+        self.options = resolved
+        self.__dict__.update(resolved)
+
     def validate(self, safe=False):
         '''Validate data and return it
         '''
+        if utils.instrumented:
+            if budgets.running:
+                budget = budgets.current()
+                if budget is not None:
+                    return budget.validate(self, safe, self.nested)
+            if profiling.active is not None:
+                return profiling.active.validate(self, safe)
+        return self.validate_raw(safe)
+
+    def validate_raw(self, safe=False):
         if not self.required and not self.raw_data:
             self.validated_data = self.raw_data
             self.absent = True
@@ -47,7 +152,76 @@ class Base(object):
     def check_data(self):
         '''Inner validation function, without `required` flag check
         '''
-        raise NotImplementedError('Define `check_data` method')
+        if self.memo is not None:
+            return self.memo.call(self.check_value, self.origin, self.raw_data)
+        return self.check_value(self.raw_data)
+
+    def check_value(self, value):
+        '''Validate scalar value and return it, schema is left untouched
+        '''
+        raise NotImplementedError('Define `check_value` method')
+
+    def inspect_value(self, value):
+        '''Validate scalar value without raising, return `(value, error)`,
+        where error is `errors.Error` or None
+        '''
+        try:
+            return self.check_value(value), None
+        except ValidationError as e:
+            return None, Error(None, e.args[0])
+
+    def value_inspector(self):
+        '''Return `inspect_value`, or generic one, that calls `check_value`,
+        if subclass overrides only `check_value`
+        '''
+        for cls in type(self).__mro__:
+            if 'inspect_value' in cls.__dict__:
+                return self.inspect_value
+            if 'check_value' in cls.__dict__:
+                return partial(Base.inspect_value.im_func, self)
+
+    def check_column(self, values):
+        '''Validate homogeneous sequence of scalar values at once
+
+        Return list of validated values and indexes of values, that must be
+        validated one by one, or None if values can not be checked at once.
+        '''
+        return None
+
+    @schemamethod
+    def compile(self):
+        '''Build immutable plan, that validates data without copying schema
+        '''
+        return plan.Plan(self)
+
+    @schemamethod
+    def validate_many(self, iterable, errors_only=False, fail_fast=False):
+        '''Validate iterable of records, see `plan.Plan.validate_many`
+        '''
+        return self.compile().validate_many(iterable, errors_only, fail_fast)
+
+    @schemamethod
+    def avalidate(self, data=None, limit=8, callback=None):
+        '''Validate data and run hooks in background, return `hooks.Future`
+        '''
+        from procrustes import hooks
+        return hooks.Future(hooks.validate, (self, data, limit), callback)
+
+    def compile_node(self):
+        if type(self).check_data.im_func is not Base.check_data.im_func:
+            return plan.InstanceNode(self)
+        return plan.ScalarNode(self)
+
+    def blank_included(self, build):
+        '''Children of blank instance, built once per schema from
+        prototypes of child types
+        '''
+        prototype = prototype_of(self.origin)
+        included = prototype.__dict__.get('_included')
+        if included is None:
+            # prototype is read-only, cache is set past its `__setattr__`
+            included = prototype.__dict__['_included'] = build()
+        return included
 
     @property
     def data(self):
@@ -61,23 +235,81 @@ class Base(object):
         if self.error:
             yield self.error
 
+    @property
+    def details(self):
+        '''Structured errors, see `results.iterdetails`'''
+        return list(results.iterdetails(self))
+
     def flatten(self, delimiter='__'):
         '''Make a version of value suitable to use in flat dictionary
         '''
-        yield '', self.validated_data
+        return utils.iterflatten(self, delimiter)
 
-    def deepen(self, flat):
+    def flat_items(self):
+        '''Return `(key, child)` pairs to flatten, or None for scalar value
+        '''
+        return None
+
+    @schemamethod
+    def deepen(self, flat, delimiter='__'):
         '''Return a canonical version of a flat representation of value
         '''
-        if flat is None:
-            return None
-        try:
-            return flat['']
-        except (KeyError, TypeError):
+        return self.deepen_tree(flat_tree(flat, delimiter))
+
+    def deepen_tree(self, tree):
+        '''Return a canonical version of value from parsed flat keys tree
+        '''
+        if tree is None:
             return None
+        return tree.get('')
+
+
+class Container(Base):
+    '''Base of validators with children
+
+    Lazy container validates data on first access to `validated_data` or
+    `error`, and makes its children lazy as well. `force` validates all
+    of tree at once.
+    '''
+    lazy = False
+    pending = False
+    nested = True
+
+    def instantiate(self, data=None, validate=True, lazy=False):
+        if lazy:
+            self.lazy = True
+        if not (validate and lazy):
+            return Base.instantiate(self, data, validate)
+        # attributes are left unset, so eager instances pay nothing
+        self.raw_data = data
+        self.pending = True
 
+    def __getattr__(self, name):
+        if name in ('validated_data', 'error') and \
+           self.__dict__.get('pending'):
+            self.validate(safe=True)
+            return self.__dict__[name]
+        raise AttributeError("'%s' object has no attribute '%s'"
+                             % (type(self).__name__, name))
 
-class Tuple(Base):
+    def validate(self, safe=False):
+        if self.pending:
+            self.pending = False
+            self.validated_data = self.default_data
+            self.error = None
+        return Base.validate(self, safe)
+
+    def force(self):
+        '''Validate deferred data of container and all its children
+        '''
+        stack = [self]
+        while stack:
+            stack.extend(child for key, child
+                         in stack.pop().flat_items() or ())
+        return self
+
+
+class Tuple(Container):
 
     def configure(self, args, kwargs):
         super(Tuple, self).configure(args, kwargs)
@@ -92,9 +324,16 @@ class Tuple(Base):
         if len(self.types) != len(data):
             raise ValidationError('Must be iterable of length %i'
                                   % len(self.types))
-        instances = [t(value, True) for t, value in zip(self.types, data)]
+        lazy = self.lazy
+        instances = [t(value, True, lazy) for t, value
+                     in zip(self.types, data)]
         return instances
 
+    def compile_node(self):
+        if type(self).check_data.im_func is not Tuple.check_data.im_func:
+            return plan.InstanceNode(self)
+        return plan.TupleNode(self)
+
     @property
     def data(self):
         if not self.validated_data:
@@ -112,47 +351,52 @@ class Tuple(Base):
 
     def get_included(self):
         if not self.validated_data:
-            return (typ(None, False) for typ in self.types)
+            return self.blank_included(
+                lambda: tuple(prototype_of(typ) for typ in self.types))
         return self.validated_data
 
-    def flatten(self, delimiter='__'):
+    def flat_items(self):
         if not self.validated_data:
-            raise StopIteration()
-        for number, value in enumerate(self.validated_data):
-            for key, data in value.flatten(delimiter):
-                tail = delimiter + key if key else ''
-                yield str(number) + tail, data
+            return ()
+        return ((str(number), value) for number, value
+                in enumerate(self.validated_data))
 
-    def deepen(self, flat, delimiter='__'):
-        collector = {}
-        set_nums = set(xrange(self.len_types))
-        for key, flatchild in sorted(group_by_key(flat, delimiter).iteritems()):
-            try:
-                number = int(key)
-            except ValueError:
-                continue
-            if number > self.len_types:
-                continue
-            collector[number] = self.types[number].deepen(flatchild)
-            set_nums.remove(number)
-        for i in set_nums: # Add unavailable slots
-            collector[i] = None
-        return tuple(v for k, v in sorted(collector.items()))
+    def deepen_tree(self, tree):
+        if tree is None:
+            tree = {}
+        # unavailable slots are None
+        return tuple(schema_of(typ).deepen_tree(tree[str(number)])
+                     if str(number) in tree else None
+                     for number, typ in enumerate(self.types))
 
 
-class List(Base):
+class List(Container):
+    path_wildcard = True
 
     def configure(self, args, kwargs):
         super(List, self).configure(args, kwargs)
         self.type = args[0]
+        self.max_length = kwargs.get('max_length')
         self.default_data = []
 
     def check_data(self):
         if not isinstance(self.raw_data, Iterable):
             raise ValidationError('Must be iterable')
-        instances = [self.type(i, True) for i in self.raw_data]
+        items = self.raw_data
+        if self.max_length is not None:
+            items = utils.take(items, self.max_length)
+            if items is None:
+                raise ValidationError('Must have at most %i items'
+                                      % self.max_length)
+        typ, lazy = self.type, self.lazy
+        instances = [typ(i, True, lazy) for i in items]
         return instances
 
+    def compile_node(self):
+        if type(self).check_data.im_func is not List.check_data.im_func:
+            return plan.InstanceNode(self)
+        return plan.ListNode(self)
+
     @property
     def data(self):
         if not self.validated_data:
@@ -170,24 +414,28 @@ class List(Base):
 
     def get_included(self):
         if not self.validated_data:
-            return [self.type(None, False)]
+            return self.blank_included(lambda: (prototype_of(self.type),))
         return self.validated_data
 
-    def flatten(self, delimiter='__'):
+    def flat_items(self):
         if not self.validated_data:
-            raise StopIteration()
-        for number, value in enumerate(self.validated_data):
-            for key, data in value.flatten(delimiter):
-                tail = delimiter + key if key else ''
-                yield str(number) + tail, data
+            return ()
+        return ((str(number), value) for number, value
+                in enumerate(self.validated_data))
 
-    def deepen(self, flat, delimiter='__'):
-        return [self.type.deepen(flatchild) for flatchild in
-                group_by_key(flat, delimiter).itervalues()]
+    def deepen_tree(self, tree):
+        if tree is None:
+            return []
+        typ = schema_of(self.type)
+        items = sorted((int(key), child) for key, child in tree.iteritems()
+                       if key.isdigit())
+        return [typ.deepen_tree(child) for number, child in items]
 
 
-class Dict(Base):
+class Dict(Container):
     named_types = {}
+    partial = False # validate only keys of data, or `fields`
+    fields = None
 
     def configure(self, args, kwargs):
         super(Dict, self).configure(args, kwargs)
@@ -198,10 +446,54 @@ class Dict(Base):
         if not isinstance(self.raw_data, dict):
             raise ValidationError('Value must be dict')
         instances = OrderedDict()
-        for name, typ in self.named_types.iteritems():
-            instances[name] = typ(self.raw_data.get(name), True)
+        get, lazy = self.raw_data.get, self.lazy
+        types = self.selected_types() if self.partial \
+            else self.named_types.iteritems()
+        for name, typ in types:
+            instances[name] = typ(get(name), True, lazy)
         return instances
 
+    def selected_types(self):
+        if not self.partial:
+            return self.named_types.iteritems()
+        fields = self.fields
+        if fields is None:
+            fields = self.raw_data
+        return [(name, typ) for name, typ in self.named_types.iteritems()
+                if name in fields]
+
+    def blank_copy(self):
+        return self(None, False)
+
+    @schemamethod
+    def validate_partial(self, data=None, fields=None, lazy=False,
+                         limits=None):
+        '''Validate only keys, that are present in data, or only `fields`,
+        and return sparse copy of schema, other fields are not instantiated
+        '''
+        instance = self.blank_copy()
+        instance.partial = True
+        instance.fields = fields
+        instance.instantiate_limited(data, True, lazy, limits)
+        return instance
+
+    @schemamethod
+    def deepen_partial(self, flat, delimiter='__', fields=None):
+        '''Deepen only fields, that have keys in flat dictionary, or only
+        `fields`
+        '''
+        tree = flat_tree(flat, delimiter) or {}
+        if fields is None:
+            fields = tree
+        return dict((name, schema_of(typ).deepen_tree(tree.get(name)))
+                    for name, typ in self.named_types.iteritems()
+                    if name in fields)
+
+    def compile_node(self):
+        if type(self).check_data.im_func is not Dict.check_data.im_func:
+            return plan.InstanceNode(self)
+        return plan.DictNode(self)
+
     @property
     def data(self):
         if not self.validated_data:
@@ -220,26 +512,209 @@ class Dict(Base):
 
     def get_included(self):
         if not self.validated_data:
-            return OrderedDict((name, typ(None, False)) for name, typ
-                               in self.named_types.iteritems())
+            return self.blank_included(
+                lambda: OrderedDict((name, prototype_of(typ)) for name, typ
+                                    in self.named_types.iteritems()))
         return self.validated_data
 
-    def flatten(self, delimiter='__'):
+    def flat_items(self):
         if not self.validated_data:
-            raise StopIteration()
-        for name, value in self.validated_data.iteritems():
-            for key, data in value.flatten(delimiter):
-                tail = delimiter + key if key else ''
-                yield name + tail, data
+            return ()
+        return self.validated_data.iteritems()
 
-    def deepen(self, flat, delimiter='__'):
-        result = {}
-        grouped = group_by_key(flat, delimiter)
-        for name, ftype in self.named_types.items():
-            flatchild = grouped.pop(name, None)
-            result[name] = ftype.deepen(flatchild)
-        # TODO we may have unmatched data in `grouped`
-        return result
+    def deepen_tree(self, tree):
+        if tree is None:
+            tree = {}
+        # TODO we may have unmatched data in `tree`
+        return dict((name, schema_of(typ).deepen_tree(tree.get(name)))
+                    for name, typ in self.named_types.iteritems())
+
+
+class Union(Container):
+    '''Value of any of `types`, first valid type is chosen
+
+    Types of the same kind as value, dicts for `Dict`, sequences for `List`
+    and `Tuple`, are tried first, others are tried after them in order.
+
+    Type is valid only if all of its subtree is valid, so types are
+    validated eagerly. Lazy union is validated on first access, as other
+    containers, and forces subtree of chosen type.
+    '''
+    exclusive = False
+    nested = False # level of chosen type
+    path_merged = True # as types are profiled by plans
+    chosen = () # indexes of chosen types of this and nested unions
+
+    def configure(self, args, kwargs):
+        super(Union, self).configure(args, kwargs)
+        self.types = args
+        self.default_data = None
+        self.orders = union_orders(args)
+
+    def check_data(self):
+        raw = self.raw_data
+        # value is counted by union, budget forgets failed types
+        budget = budgets.current() if budgets.running else None
+        chosen = None
+        for index in self.orders[kind_of(raw)]:
+            if budget is not None:
+                mark = budget.attempt(raw)
+            instance = self.types[index](raw, True)
+            failed = bool(instance.errors)
+            if budget is not None:
+                budget.attempted(mark, failed)
+            if failed:
+                continue
+            if not self.exclusive:
+                self.chosen = (index,) + getattr(instance, 'chosen', ())
+                return instance
+            if chosen is not None:
+                raise ValidationError('Must match exactly one of %i schemas'
+                                      % len(self.types))
+            chosen, chosen_index = instance, index
+        if chosen is None:
+            raise ValidationError('Must match one of %i schemas'
+                                  % len(self.types))
+        self.chosen = (chosen_index,) + getattr(chosen, 'chosen', ())
+        return chosen
+
+    def compile_node(self):
+        if type(self).check_data.im_func is not Union.check_data.im_func:
+            return plan.InstanceNode(self)
+        return plan.UnionNode(self)
+
+    @property
+    def data(self):
+        if self.absent:
+            return self.validated_data
+        if self.validated_data is None:
+            return
+        return self.validated_data.data
+
+    def get_included(self):
+        if self.absent or self.validated_data is None:
+            return prototype_of(self.types[0])
+        return self.validated_data
+
+    def flat_items(self):
+        if self.absent:
+            return ()
+        if self.validated_data is None:
+            return None
+        return self.validated_data.flat_items()
+
+    def deepen_tree(self, tree):
+        if tree is None:
+            return None
+        if '' in tree:
+            kind = 'scalar'
+        elif tree and all(key.isdigit() for key in tree):
+            kind = 'sequence'
+        else:
+            kind = 'dict'
+        candidates = [schema_of(self.types[index])
+                      for index in self.orders[kind]]
+        if kind == 'dict':
+            # dict with most of keys
+            candidates.sort(key=lambda schema: -len(
+                set(tree).intersection(getattr(schema, 'named_types', ()))))
+        return candidates[0].deepen_tree(tree)
+
+
+class OneOf(Union):
+    '''Value of exactly one of `types`, all types are tried
+    '''
+    exclusive = True
+
+
+class Tagged(Container):
+    '''Dict, validated by one of `Dict` variants, chosen by value of `key`
+
+        >>> Tagged('type', {'click': Click, 'scroll': Scroll})
+
+    Variant is looked up in dict, other variants are not tried. Tag is
+    kept in data, even if variant has no field for it.
+    '''
+    nested = False # level of variant
+    path_merged = True
+
+    def configure(self, args, kwargs):
+        super(Tagged, self).configure(args, kwargs)
+        self.key, self.variants = args
+        self.default_data = None
+        self.tag = None
+
+    def check_data(self):
+        raw = self.raw_data
+        if not isinstance(raw, dict):
+            raise ValidationError('Value must be dict')
+        tag = raw.get(self.key)
+        typ = self.variant_of(tag)
+        if typ is None:
+            raise ValidationError('Value of %s must be one of: %s' % (
+                self.key, ', '.join(map(unicode, sorted(self.variants)))))
+        self.tag = tag
+        budget = budgets.current() if budgets.running else None
+        if budget is None:
+            return typ(raw, True, self.lazy)
+        # value is counted by tagged validator
+        mark = budget.attempt(raw)
+        try:
+            return typ(raw, True, self.lazy)
+        finally:
+            budget.attempted(mark, False)
+
+    def variant_of(self, tag):
+        try:
+            return self.variants.get(tag)
+        except TypeError: # unhashable
+            return None
+
+    def compile_node(self):
+        if type(self).check_data.im_func is not Tagged.check_data.im_func:
+            return plan.InstanceNode(self)
+        return plan.TaggedNode(self)
+
+    @property
+    def data(self):
+        if self.absent:
+            return self.validated_data
+        if self.validated_data is None:
+            return
+        data = self.validated_data.data or {}
+        data.setdefault(self.key, self.tag)
+        return data
+
+    def itererrors(self):
+        if self.error:
+            yield self.error
+        if not self.absent and self.validated_data is not None:
+            for error in self.validated_data.itererrors():
+                yield error
+
+    def get_included(self):
+        if self.absent or self.validated_data is None:
+            return prototype_of(self.variants[sorted(self.variants)[0]])
+        return self.validated_data
+
+    def flat_items(self):
+        if self.absent or self.validated_data is None:
+            return ()
+        items = self.validated_data.flat_items() or ()
+        if self.key in self.validated_data.named_types:
+            return items
+        return chain([(self.key, results.Result(self.tag))], items)
+
+    def deepen_tree(self, tree):
+        if tree is None:
+            tree = {}
+        tag = (tree.get(self.key) or {}).get('')
+        typ = self.variant_of(tag)
+        if typ is None:
+            return {self.key: tag}
+        data = schema_of(typ).deepen_tree(tree)
+        data.setdefault(self.key, tag)
+        return data
 
 
 class String(Base):
@@ -250,24 +725,68 @@ class String(Base):
         self.max_length = kwargs.get('max_length')
         regex = kwargs.get('regex')
         regex_msg = kwargs.get('regex_msg')
-        self.regex = re.compile(regex) if regex is not None else None
+        if isinstance(regex, basestring):
+            regex = utils.patterns.compile(regex)
+            # copies of schema get compiled pattern
+            self.kwargs['regex'] = regex
+        self.regex = regex
         self.regex_msg = regex_msg if regex_msg else 'Dont match'
 
-    def check_data(self):
-        if not isinstance(self.raw_data, (str, unicode)):
+    def check_value(self, value):
+        # subclass, that overrides only `inspect_value`, checks by it
+        typ = type(self)
+        if typ.inspect_value.im_func is not String.inspect_value.im_func:
+            return unwrap(*self.inspect_value(value))
+        # checks of `inspect_value`, instance path raises without `Error`
+        if not isinstance(value, (str, unicode)):
             raise ValidationError('Must be str or unicode instance')
-        slen = len(self.raw_data)
+        slen = len(value)
 
         if self.min_length is not None and slen < self.min_length:
             raise ValidationError('Must be longer than %i' % self.min_length)
         if self.max_length is not None and slen > self.max_length:
             raise ValidationError('Must be shorter than %i' % self.max_length)
         if self.regex:
-            match = self.regex.match(self.raw_data)
-            if match is None or match.group()!=self.raw_data:
+            match = self.regex.match(value)
+            if match is None or match.group()!=value:
                 raise ValidationError(self.regex_msg)
 
-        return self.raw_data
+        return value
+
+    def inspect_value(self, value):
+        if not isinstance(value, (str, unicode)):
+            return None, Error('type', 'Must be str or unicode instance')
+        slen = len(value)
+
+        if self.min_length is not None and slen < self.min_length:
+            return None, Error('min_length', 'Must be longer than %i',
+                               (self.min_length,))
+        if self.max_length is not None and slen > self.max_length:
+            return None, Error('max_length', 'Must be shorter than %i',
+                               (self.max_length,))
+        if self.regex:
+            match = self.regex.match(value)
+            if match is None or match.group()!=value:
+                return None, Error('regex', self.regex_msg)
+
+        return value, None
+
+    def check_column(self, values):
+        if not own_checks(self, String) or self.regex or \
+           not isinstance(values, (list, tuple)):
+            return None
+        if not set(map(type, values)) <= set([str, unicode]):
+            return None
+        lengths = map(len, values)
+        low, high = self.min_length, self.max_length
+        if lengths and (low is not None and min(lengths) < low or
+                        high is not None and max(lengths) > high):
+            failed = [index for index, length in enumerate(lengths)
+                      if low is not None and length < low or
+                      high is not None and length > high]
+        else:
+            failed = []
+        return list(values), failed
 
 
 class Integer(Base):
@@ -277,9 +796,14 @@ class Integer(Base):
         self.min = kwargs.get('min')
         self.max = kwargs.get('max')
 
-    def check_data(self):
+    def check_value(self, value):
+        # subclass, that overrides only `inspect_value`, checks by it
+        typ = type(self)
+        if typ.inspect_value.im_func is not Integer.inspect_value.im_func:
+            return unwrap(*self.inspect_value(value))
+        # checks of `inspect_value`, instance path raises without `Error`
         try:
-            i = int(self.raw_data)
+            i = int(value)
         except (ValueError, TypeError):
             raise ValidationError('Must be number, not a string')
 
@@ -290,10 +814,57 @@ class Integer(Base):
 
         return i
 
+    def inspect_value(self, value):
+        try:
+            i = int(value)
+        except (ValueError, TypeError):
+            return None, Error('type', 'Must be number, not a string')
+
+        if self.min is not None and i < self.min:
+            return None, Error('min', 'Must be larger than %i', (self.min,))
+        if self.max is not None and i > self.max:
+            return None, Error('max', 'Must be smaller than %i', (self.max,))
+
+        return i, None
+
+    def check_column(self, values):
+        if not own_checks(self, Integer):
+            return None
+        low, high = self.min, self.max
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            if values.ndim != 1 or values.dtype.kind not in 'iu':
+                return None
+            mask = numpy.zeros(len(values), dtype=bool)
+            if low is not None:
+                mask |= values < low
+            if high is not None:
+                mask |= values > high
+            return values.tolist(), numpy.flatnonzero(mask).tolist()
+        if isinstance(values, array):
+            if values.typecode not in 'bBhHiIlL':
+                return None
+            data = values.tolist()
+        elif isinstance(values, (list, tuple)) and \
+                set(map(type, values)) == set([int]):
+            data = list(values)
+        else:
+            return None
+        if data and (low is not None and min(data) < low or
+                     high is not None and max(data) > high):
+            failed = [index for index, value in enumerate(data)
+                      if low is not None and value < low or
+                      high is not None and value > high]
+        else:
+            failed = []
+        return data, failed
+
 
 class Boolean(Base):
-    def check_data(self):
-        return bool(self.raw_data)
+    def check_value(self, value):
+        return bool(value)
+
+    def inspect_value(self, value):
+        return bool(value), None
 
 
 # nice declarativeness
@@ -318,29 +889,88 @@ class DeclarativeMeta(type):
 class Declarative(Dict):
     __metaclass__ = DeclarativeMeta
 
-    def __init__(self, data, validate=True):
+    def __init__(self, data=None, validate=True, lazy=False, limits=None):
         super(Declarative, self).__init__(*list(self.args), **self.kwargs.copy())
-        self.instantiate(data, validate)
+        self.origin = type(self)
+        self.instantiate_limited(data, validate, lazy, limits)
+
+    def blank_copy(self):
+        return type(self)(None, False)
 
 
 # Helpers
+def unwrap(value, error):
+    '''Return value of `inspect_value` result or raise its error'''
+    if error is not None:
+        raise ValidationError(error.message)
+    return value
+
+
+def own_checks(schema, cls):
+    '''True if values of schema are checked by `check_value` and
+    `inspect_value` of `cls`, so checks of `cls` may be inlined
+    '''
+    typ = type(schema)
+    return typ.check_value.im_func is cls.check_value.im_func and \
+        typ.inspect_value.im_func is cls.inspect_value.im_func
+
+
+def union_orders(types):
+    '''Return orders of indexes of types, that `Union` tries for every
+    kind of value
+    '''
+    kinds = []
+    for typ in types:
+        schema = schema_of(typ)
+        if isinstance(schema, (Dict, Tagged)):
+            kinds.append('dict')
+        elif isinstance(schema, (List, Tuple)):
+            kinds.append('sequence')
+        elif isinstance(schema, Union):
+            kinds.append(None) # any kind
+        else:
+            kinds.append('scalar')
+    orders = {}
+    for kind in ('dict', 'sequence', 'scalar'):
+        first = [index for index, typ_kind in enumerate(kinds)
+                 if typ_kind in (kind, None)]
+        orders[kind] = tuple(first + [index for index in xrange(len(kinds))
+                                      if index not in first])
+    return orders
+
+
+def memoize(schema, cache=1024):
+    '''Cache checks of all scalar validators of schema in one cache
+
+    `cache` is size of new cache or `utils.ValueCache`, it is returned.
+    Schema must be memoized before it is compiled.
+    '''
+    if not isinstance(cache, utils.ValueCache):
+        cache = utils.ValueCache(cache)
+    stack = [schema_of(schema)]
+    while stack:
+        schema = stack.pop()
+        if isinstance(schema, List):
+            stack.append(schema_of(schema.type))
+        elif isinstance(schema, Dict):
+            stack.extend(schema_of(typ) for typ
+                         in schema.named_types.itervalues())
+        elif isinstance(schema, (Tuple, Union)):
+            stack.extend(schema_of(typ) for typ in schema.types)
+        elif isinstance(schema, Tagged):
+            stack.extend(schema_of(typ) for typ in schema.variants.values())
+        elif type(schema).check_data.im_func is Base.check_data.im_func:
+            schema.configure_options(memo=cache)
+    return cache
+
+
 def group_by_key(flat, delimiter='__'):
     if flat is None:
         return {}
 
-    def split_key(flat):
-        for key, value in sorted(flat.iteritems()):
-            keys = key.split(delimiter, 1)
-            base_key = keys[0]
-            child_key = keys[1] if len(keys) == 2 else ''
-            yield base_key, child_key, value
-
     collector = defaultdict(dict)
-    for key, child_key, value in split_key(flat):
-        collector[key][child_key] = value
+    for key, value in flat.iteritems():
+        keys = key.split(delimiter, 1)
+        child_key = keys[1] if len(keys) == 2 else ''
+        collector[keys[0]][child_key] = value
     return collector
-
-
-# Exceptions
-class ValidationError(Exception):
-    pass
@@ -1,5 +1,7 @@
 # (c) Svarga project under terms of the new BSD license
 
+from copy import copy
+
 
 # Widgets
 class Base(object):
@@ -18,6 +20,11 @@ class Base(object):
         self.name = self.prefix + ('__' + id if id else '')
         self.parent_label = self.prefix + delimiter + self.parent
 
+    def clone(self):
+        '''Return copy, that may be changed without changing this widget'''
+        widget = copy(self)
+        widget.attrs = dict(self.attrs)
+        return widget
 
     def render(self):
         data = self.data if self.data else ''
@@ -1,7 +1,21 @@
 # (c) Svarga project under terms of the new BSD license
 
+import json
 from procrustes import procrustes
 from procrustes import forms
+from procrustes import utils
+from procrustes import errors
+from procrustes import codegen
+from procrustes import profiling
+from procrustes import render
+from procrustes import parallel
+from procrustes import jsonstream
+from procrustes import budgets
+from procrustes import serialize
+from array import array
+from itertools import count
+from StringIO import StringIO
+from threading import Thread
 from attest import Tests, Assert
 
 p = Tests()
@@ -94,6 +108,183 @@ def declarative():
     Assert(fail.errors) == ['Must be shorter than 5']
 
 
+@p.test
+def compiled_plan():
+    class Pet(procrustes.Declarative):
+        name = procrustes.String(max_length=5)
+        age = procrustes.Integer(min=0)
+
+    PT = procrustes.Tuple(I, S, I)
+    PD = procrustes.Dict({'a': I, 'b': S, 'c': PT,
+                          'pets': procrustes.List(Pet, required=False)})
+    values = [{'b': 'kuku', 'c': (None, 'Lorem', 91)},
+              {'b': '', 'c': [1, 2], 'pets': [{'name': 'cat', 'age': -1},
+                                              {'name': 'doggy', 'age': 3}]},
+              {'b': 'kuku', 'c': (1, 'a', 2), 'pets': []},
+              None, 'kuku']
+    plan = PD.compile()
+    for value in values:
+        result = plan(value)
+        instance = PD(value)
+        Assert(result.data) == instance.data
+        Assert(result.errors) == instance.errors
+
+    result = Pet.compile()({'name': 'qweasd', 'age': 1})
+    Assert(result.data) == {'name': None, 'age': 1}
+    Assert(result.errors) == ['Must be shorter than 5']
+
+
+@p.test
+def plan_results():
+    PD = procrustes.Dict({'a': I, 'b': procrustes.List(S)})
+    plan = PD.compile()
+    result = plan({'a': 100, 'b': ['kuku', '']})
+    Assert(hasattr(result, '__dict__')) == False
+    Assert(result['a'].error) == 'Must be smaller than 90'
+    Assert([child.data for child in result['b'].children]) == ['kuku', None]
+    Assert(result.errors) == ['Must be smaller than 90',
+                              'Must be longer than 1']
+    Assert(plan({'b': ['kuku']}).data) == {'a': None, 'b': ['kuku']}
+
+
+@p.test
+def regex_cache():
+    cache = utils.PatternCache(maxsize=2)
+    Assert(cache.compile('a+')) == cache.compile('a+')
+    cache.compile('b+')
+    cache.compile('c+')
+    Assert(cache.stats()) == {'hits': 1, 'misses': 3, 'size': 2, 'maxsize': 2}
+
+    R = procrustes.String(regex='[a-z]+', regex_msg='Lowercase only')
+    misses = utils.patterns.misses
+    Assert(R('kuku').data) == 'kuku'
+    Assert(R('Kuku').errors) == ['Lowercase only']
+    Assert(procrustes.List(R)(['a', 'b', 'c']).data) == ['a', 'b', 'c']
+    Assert(utils.patterns.misses) == misses
+
+
+@p.test
+def validate_many():
+    class Pet(procrustes.Declarative):
+        name = procrustes.String(max_length=5)
+
+    records = ({'name': name} for name in ['cat', 'doggy', 'hamster', ''])
+    Assert(list(Pet.validate_many(records))) == [
+        (0, {'name': 'cat'}, []),
+        (1, {'name': 'doggy'}, []),
+        (2, {'name': None}, ['Must be shorter than 5']),
+        (3, {'name': None}, ['Must be longer than 1'])]
+
+    records = [[1, 'a'], [2, 'b'], [3]]
+    PT = procrustes.Tuple(I, S)
+    Assert(list(PT.validate_many(records, errors_only=True))) == [
+        (2, None, ['Must be iterable of length 2'])]
+
+
+@p.test
+def fail_fast():
+    PD = procrustes.Dict({'pets': procrustes.List(procrustes.Tuple(S, I))})
+    plan = PD.compile()
+    data = {'pets': [('cat', 1), ('dog', 'many'), ('', 'x')]}
+    result = plan(data, fail_fast=True)
+    Assert(result.errors) == ['Must be number, not a string']
+    Assert(result.path) == ('pets', 1, 1)
+    Assert(result.data) == None
+    Assert(len(plan(data).errors)) == 3
+
+    result = plan({'pets': [('cat', 1)]}, fail_fast=True)
+    Assert(result.data) == {'pets': [('cat', 1)]}
+    Assert(result.errors) == []
+
+
+@p.test
+def generated_plan():
+    class Even(procrustes.Base):
+        def check_value(self, value):
+            if value % 2:
+                raise procrustes.ValidationError('Must be even')
+            return value
+
+    class Pet(procrustes.Declarative):
+        name = procrustes.String(max_length=5, regex='[a-z]+')
+        alive = procrustes.Boolean()
+
+    PD = procrustes.Dict({'pets': procrustes.List(Pet, required=False),
+                          'pair': procrustes.Tuple(I, Even()),
+                          'code': procrustes.String(required=False)})
+    values = [{'pets': [{'name': 'cat', 'alive': 1}, {'name': 'Cat'},
+                        {'name': 'kitten'}, None],
+               'pair': (100, 3), 'code': 'x'},
+              {'pets': [], 'pair': ('x', 2), 'code': ''},
+              {'pair': [1]}, {'pair': 1}, None]
+    generated = codegen.compile(PD)
+    interpreted = PD.compile()
+    for value in values:
+        Assert(generated(value).data) == interpreted(value).data
+        Assert(generated(value).errors) == interpreted(value).errors
+    Assert(generated({'pair': (1, 3)}, fail_fast=True).path) == ('pair', 1)
+    Assert('Must be shorter than 5' in codegen.source(PD)) == True
+
+
+@p.test
+def profiler():
+    class Pet(procrustes.Declarative):
+        name = procrustes.String(max_length=5)
+
+    PD = procrustes.Dict({'pets': procrustes.List(Pet), 'owner': S})
+    data = {'pets': [{'name': 'cat'}, {'name': 'kitten'}, {'name': 'dog'}],
+            'owner': 'kuku'}
+    plan = PD.compile()
+    for validate in (PD, plan):
+        with profiling.Profiler() as profiler:
+            validate(data)
+        stats = profiler.as_dict()
+        Assert(sorted(stats)) == ['', 'owner', 'pets', 'pets.*',
+                                  'pets.*.name']
+        Assert(stats['pets.*.name']['calls']) == 3
+        Assert(stats['pets.*.name']['errors']) == 1
+        Assert(stats['']['self'] <= stats['']['cumulative']) == True
+    Assert(profiling.active) == None
+    Assert('procrustes_validation_calls_total{path="pets.*.name"} 3'
+           in profiler.prometheus()) == True
+
+    # types of unions are profiled at path of union by both
+    Key = procrustes.Dict({'a': procrustes.Integer()})
+    UD = procrustes.Dict({
+        'u': procrustes.Union(procrustes.Integer(), Key),
+        't': procrustes.Tagged('type', {'key': Key}),
+        'l': procrustes.List(procrustes.Union(procrustes.String(), Key))})
+    values = {'u': {'a': 1}, 't': {'type': 'key', 'a': 2},
+              'l': ['x', {'a': 'bad'}, {'a': 3}]}
+    paths = []
+    for validate in (UD, UD.compile()):
+        with profiling.Profiler() as profiler:
+            validate(values)
+        paths.append(dict((path, (stat['calls'], stat['errors'])) for path,
+                          stat in profiler.as_dict().iteritems()))
+    Assert(paths[0]) == paths[1]
+    Assert(sorted(paths[0])) == ['', 'l', 'l.*', 'l.*.a', 't', 't.a', 'u',
+                                 'u.a']
+
+    # validations in threads do not mix their frames
+    def worker():
+        for i in xrange(20):
+            PD(data)
+            plan(data)
+    with profiling.Profiler() as profiler:
+        threads = [Thread(target=worker) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    stats = profiler.as_dict()
+    Assert(sorted(stats)) == ['', 'owner', 'pets', 'pets.*', 'pets.*.name']
+    Assert(stats['']['calls']) == 160
+    Assert(stats['pets.*.name']['calls']) == 480
+    Assert(all(stat['self'] <= stat['cumulative'] + 1e-9
+               for stat in stats.values())) == True
+
+
 @p.test
 def forms_simple():
     str = forms.String()('kukuku')
@@ -136,16 +327,771 @@ def forms_flat():
     FD = forms.Dict({'a': forms.String(), 'b': forms.String(), 'c': FL})
     flat = {'form__a': 'kuku', 'form__b': 'may-may', 'form__c__0': 'wer', 'form__c__1': 'kuku'}
     unflat = FD.unflat(flat)
-    Assert(unflat) == {'a': 'kuku', 'b': 'may-may', 'c': ['kuku', 'wer']}
+    Assert(unflat) == {'a': 'kuku', 'b': 'may-may', 'c': ['wer', 'kuku']}
     fd = FD(unflat)
     widgets = [widget.render() for widget in fd.widgets() if widget.render()]
     Assert(widgets) == ['<input id="form__a" name="form__a" parent="" value="kuku">',
-                        '<input id="form__c__0" name="form__c__0" parent="" value="kuku">',
-                        '<input id="form__c__1" name="form__c__1" parent="" value="wer">',
+                        '<input id="form__c__0" name="form__c__0" parent="" value="wer">',
+                        '<input id="form__c__1" name="form__c__1" parent="" value="kuku">',
                         '<input id="form__b" name="form__b" parent="" value="may-may">']
     form = FD(flat)
     Assert(form.is_valid()) == True
-    Assert(form.data) == {'a': 'kuku', 'b': 'may-may', 'c': ['kuku', 'wer']}
+    Assert(form.data) == {'a': 'kuku', 'b': 'may-may', 'c': ['wer', 'kuku']}
+
+
+@p.test
+def deepen_list_order():
+    class Pet(procrustes.Declarative):
+        name = procrustes.String()
+
+    PD = procrustes.Dict({'pets': procrustes.List(Pet),
+                          'pair': procrustes.Tuple(S, S)})
+    flat = dict(('pets__%i__name' % i, str(i)) for i in xrange(12))
+    flat['pair__1'] = 'b'
+    flat['pets__x'] = 'junk'
+    deep = PD.deepen(flat)
+    Assert(deep['pets']) == [{'name': str(i)} for i in xrange(12)]
+    Assert(deep['pair']) == (None, 'b')
+    Assert(Pet.deepen({'name': 'cat'})) == {'name': 'cat'}
+
+
+@p.test
+def streaming_flat():
+    class Pet(forms.Declarative):
+        name = forms.String()
+        age = forms.Integer()
+
+    class Form(forms.Declarative):
+        name = forms.String()
+        pets = forms.List(Pet)
+
+    def pairs():
+        yield 'form__name', 'kuku'
+        for i in xrange(3):
+            yield 'form__pets__%i__name' % i, 'pet%i' % i
+            yield 'form__pets__%i__age' % i, str(i) if i != 1 else 'x'
+
+    form = Form(None, False)
+    decoded = [(path, result.data, result.errors)
+               for path, result in form.iterunflat(pairs())]
+    Assert(decoded) == [
+        (('pets', 0), {'name': 'pet0', 'age': 0}, []),
+        (('pets', 1), {'name': 'pet1', 'age': None},
+         ['Must be number, not a string']),
+        (('pets', 2), {'name': 'pet2', 'age': 2}, []),
+        ((), {'name': 'kuku', 'pets': None}, [])]
+
+    result = Pet.compile()({'name': 'cat', 'age': 3})
+    Assert(sorted(result.flatten())) == [('age', 3), ('name', 'cat')]
+    PL = procrustes.List(procrustes.Tuple(S, I))
+    Assert(list(PL.compile()([('a', 1)]).flatten())) == [('0__0', 'a'),
+                                                         ('0__1', 1)]
+
+
+@p.test
+def form_renderer():
+    class Pet(forms.Declarative):
+        name = forms.String(field_name='Name', w_class='pet')
+        alive = forms.Boolean()
+        field_name = 'Pet'
+
+    class Form(forms.Declarative):
+        name = forms.String(field_name='Your name')
+        pets = forms.List(Pet)
+        pair = forms.Tuple(forms.Integer(), forms.String())
+
+    renderer = render.Renderer(Form)
+
+    def expected(form):
+        html = []
+        for widget in form.widgets():
+            if widget.marker == 'place':
+                html.append(renderer.place.format(
+                    parent_label=widget.parent_label,
+                    label_name=widget.label_name))
+            elif widget.marker == 'start':
+                html.append(renderer.start)
+            elif widget.marker == 'stop':
+                html.append(renderer.stop)
+            else:
+                html.append(renderer.row.format(label=widget.label(),
+                                                input=widget.render(),
+                                                error=widget.error or ''))
+        return u''.join(html)
+
+    data = {'name': 'kuku', 'pair': (1, ''),
+            'pets': [{'name': 'cat', 'alive': True}, {'name': ''}]}
+    for form in (Form(data), Form(None, False), Form({'name': 'x'})):
+        Assert(renderer.render(form)) == expected(form)
+    Assert(renderer.render(Form.compile()(data))) == expected(Form(data))
+    Assert(''.join(renderer.wsgi(Form(data), buffer_size=10))) == \
+        expected(Form(data)).encode('utf-8')
+
+    class Prefixed(forms.Declarative):
+        name = forms.String(w_prefix='zz')
+
+    renderer = render.Renderer(Prefixed)
+    form = Prefixed({'name': 'kuku'})
+    Assert(renderer.render(form)) == expected(form)
+    widget = list(form.widgets())[0]
+    Assert(widget.render() in renderer.render(form)) == True
+    Assert(widget.name) == 'zz__name'
+
+
+@p.test
+def template_cache():
+    class Pet(forms.Declarative):
+        name = forms.String(field_name='Name')
+        field_name = 'Pet'
+
+    class Form(forms.Declarative):
+        name = forms.String()
+        pets = forms.List(Pet)
+
+    first = list(Form({'name': 'kuku'}).template_widgets())
+    Assert([widget.marker for widget in first]) == ['start', False, 'stop']
+    Assert(first[1].name) == 'form__pets__%s__name'
+    # other instance of the same schema gets copies of cached widgets
+    first[1].data = 'changed'
+    first[1].attrs['class'] = 'changed'
+    second = list(Form(None, False).template_widgets())
+    Assert([widget.name for widget in second]) == \
+        [widget.name for widget in first]
+    Assert(second[1].data) == None
+    Assert(second[1].attrs) == {'parent': 'pets'}
+    Assert(list(Form().template_widgets(delimiter='-'))[0].name) == \
+        'form__pets-'
+
+    # rebuilt schema gets its own templates
+    pets = forms.List(forms.String())
+    rebuilt = forms.List(forms.String())
+    Assert(pets({}).origin).is_(pets)
+    Assert(list(pets().template_widgets())[0]).is_not(
+        list(rebuilt().template_widgets())[0])
+
+    renderer = render.Renderer(Form)
+    html = renderer.render_templates()
+    Assert(html).is_(renderer.render_templates())
+    Assert('id="template__form__pets"' in html) == True
+    Assert('name="form__pets__%s__name"' in html) == True
+
+
+@p.test
+def blank_prototypes():
+    class Form(forms.Declarative):
+        name = forms.String()
+        pets = forms.List(forms.Dict({'name': forms.String()}))
+        pair = forms.Tuple(forms.Integer(), forms.String())
+
+    form, other = Form(None, False), Form()
+    Assert(form.name).is_(form.name)
+    Assert(form.name).is_(other.name)
+    Assert(form.name.data) == None
+    Assert(form.pets.get_included()).is_(other.pets.get_included())
+    Assert(form.pair.get_included()).is_(Form().pair.get_included())
+    # validated forms have own children
+    Assert(Form({'name': 'kuku'}).name.data) == 'kuku'
+    Assert(Form({'name': 'kuku'}).name).is_not(form.name)
+    Assert([w.name for w in form.widgets()]) == \
+        [w.name for w in Form(None, False).widgets()]
+    # shared children are read-only, called ones are copies
+    with Assert.raises(TypeError):
+        form.name.raw_data = 'leaked'
+    Assert(Form(None, False).name.raw_data) == None
+    Assert(form.name('kuku').data) == 'kuku'
+    copy = form.pets.get_included()[0]({'name': 'cat'})
+    copy.validated_data = None
+    Assert(form.pets.get_included()[0].data) == None
+
+
+@p.test
+def revalidate():
+    item = procrustes.Dict({'id': procrustes.Integer(min=0),
+                            'tag': procrustes.String()})
+    schema = procrustes.Dict({'name': procrustes.String(),
+                              'items': procrustes.List(item),
+                              'pair': procrustes.Tuple(procrustes.Integer(),
+                                                       procrustes.String())})
+    plan = schema.compile()
+    data = {'name': 'kuku', 'pair': (1, 'a'),
+            'items': [{'id': i, 'tag': 't%i' % i} for i in range(3)]}
+    result = plan(data)
+    Assert(result.errors) == []
+
+    changed = plan.revalidate(result, {'items__1__id': -1, 'pair__1': 'b'})
+    Assert(changed.errors) == ['Must be larger than 0']
+    Assert(changed['name']).is_(result['name'])
+    Assert(changed['items'].children[0]).is_(result['items'].children[0])
+    Assert(changed['items'].children[1]['tag']).is_(
+        result['items'].children[1]['tag'])
+    Assert(changed.data['pair']) == (1, 'b')
+    Assert(result.errors) == []
+
+    fixed = plan.revalidate(changed, {'items__1__id': '5',
+                                      'items__3__id': 7, 'items__3__tag': 'x'})
+    expected = schema(data).data
+    expected['pair'] = (1, 'b')
+    expected['items'][1]['id'] = 5
+    expected['items'].append({'id': 7, 'tag': 'x'})
+    Assert(fixed.data) == expected
+    Assert(fixed.errors) == []
+    # failed containers are validated from changes
+    Assert(plan.revalidate(plan('kuku'), {'name': 'a'}).errors) == \
+        plan({'name': 'a'}).errors
+    # sparse results keep their own names
+    sparse = plan.validate_partial({'pair': (1, 'a')})
+    changed = plan.revalidate(sparse, {'pair__0': 'x', 'name': 'bob'})
+    Assert(changed.data) == {'pair': (None, 'a'), 'name': 'bob'}
+    Assert(changed.errors) == ['Must be number, not a string']
+    merged = result.merge(plan.validate_partial({'name': 'ann'}))
+    Assert(plan.revalidate(merged, {'name': ''}).errors) == \
+        ['Must be longer than 1']
+
+
+@p.test
+def memoized_checks():
+    S = procrustes.String(regex='[a-z]+', memoize=4)
+    L = procrustes.List(S)
+    Assert(L(['a', 'b', 'a', 'B', 'B']).errors) == ['Dont match'] * 2
+    Assert(S.memo.stats()) == {'hits': 2, 'misses': 3, 'evictions': 1,
+                               'unhashable': 0, 'size': 2, 'maxsize': 4}
+    # value types are not mixed
+    Assert(type(L([u'b']).data[0])) == unicode
+    Assert(L.compile()(['a', 'b', 'B']).errors) == ['Dont match']
+    Assert(codegen.compile(L)(['b', 'B']).errors) == ['Dont match']
+    Assert(S.memo.stats()['hits']) == 4
+
+    I = forms.Integer(min=0)
+    D = procrustes.Dict({'i': I, 'b': procrustes.Boolean(),
+                         'l': procrustes.List(procrustes.String())})
+    cache = procrustes.memoize(D, 10)
+    Assert(I.memo).is_(cache)
+    Assert(D({'i': -1, 'b': [1], 'l': ['x']}).errors) == \
+        ['Must be larger than 0']
+    Assert(D.compile()({'i': -1, 'b': [1], 'l': ['x']}).errors) == \
+        ['Must be larger than 0']
+    Assert(cache.stats()['hits']) == 2
+    Assert(cache.stats()['unhashable']) == 2
+
+
+@p.test
+def parallel_list():
+    item = procrustes.Dict({'id': procrustes.Integer(min=0),
+                            'tag': procrustes.String(memoize=10)})
+    schema = procrustes.List(item)
+    data = [{'id': i, 'tag': 't%i' % (i % 5)} for i in range(250)]
+    data[130]['id'] = -1
+    expected = schema.compile()(data)
+    for threads in (False, True):
+        with parallel.ListPlan(schema, 2, chunk_size=40,
+                               threads=threads) as plan:
+            result = plan(data)
+            Assert(result.data) == expected.data
+            Assert(result.errors) == ['Must be larger than 0']
+            Assert(dict(result.flatten())['130__id']) == None
+            failed = plan(iter(data), fail_fast=True)
+            Assert(failed.path) == (130, 'id')
+            Assert(plan(data[:10]).data) == expected.data[:10]
+            Assert(plan(5).errors) == ['Must be iterable']
+
+    # generator is consumed by window of chunks, and not after failure
+    consumed = []
+
+    def items():
+        for number in count():
+            consumed.append(number)
+            yield {'id': -1 if number == 5 else number, 'tag': 't'}
+
+    with parallel.ListPlan(schema, 2, chunk_size=10, threads=True,
+                           window=3) as plan:
+        Assert(plan(items(), fail_fast=True).path) == (5, 'id')
+        Assert(len(consumed)) <= 40
+
+
+@p.test
+def async_hooks():
+    calls = []
+
+    def taken(names):
+        calls.append(names)
+        return ['Name is taken' if name == 'bob' else None for name in names]
+
+    def known(ids):
+        calls.append(ids)
+        return [None if i < 10 else 'Unknown id' for i in ids]
+
+    user = procrustes.Dict({'name': procrustes.String(hooks=[taken]),
+                            'group': procrustes.Integer(hooks=[known])})
+    schema = procrustes.List(user)
+    data = [{'name': 'ann', 'group': 1}, {'name': 'bob', 'group': 20},
+            {'name': '', 'group': 2}]
+    Assert(schema(data).errors) == ['Must be longer than 1']
+
+    done = []
+    result = schema.avalidate(data, limit=2, callback=done.append).get(5)
+    Assert(sorted(result.errors)) == ['Must be longer than 1',
+                                      'Name is taken', 'Unknown id']
+    Assert(sorted(calls)) == [[1, 20, 2], ['ann', 'bob']]
+    Assert(done) == [result]
+    # rejected values are cleared, as values of failed checks
+    Assert(result.data) == [{'name': 'ann', 'group': 1},
+                            {'name': None, 'group': None},
+                            {'name': None, 'group': 2}]
+    both = procrustes.String(hooks=[taken, taken])
+    Assert(procrustes.List(both).avalidate(['bob', 'ann']).get(5).data) == \
+        [None, 'ann']
+    Assert(calls[-2:]) == [['bob', 'ann'], ['ann']]
+    rejected = procrustes.List(procrustes.Integer(), hooks=[lambda values: [
+        'Too long' if len(value) > 2 else None for value in values]])
+    result = procrustes.Dict({'ids': rejected}).avalidate(
+        {'ids': [1, 2, 3]}).get(5)
+    Assert(result.data) == {'ids': None}
+    Assert(result.errors) == ['Too long']
+
+    def broken(values):
+        raise KeyError('db is down')
+    future = procrustes.String(hooks=[broken]).avalidate('kuku')
+    with Assert.raises(KeyError):
+        future.get(5)
+    # every value must get its error or None
+    future = procrustes.List(procrustes.String(hooks=[lambda names: []])) \
+        .avalidate(['ann', 'bob'])
+    with Assert.raises(ValueError):
+        future.get(5)
+
+
+@p.test
+def columns():
+    numbers = procrustes.List(procrustes.Integer(min=0, max=100)).compile()
+    for raw in ([5, 200, 7, -1], array('i', [5, 200, 7, -1])):
+        result = numbers(raw)
+        Assert(result.data) == [5, None, 7, None]
+        Assert(result.errors) == ['Must be smaller than 100',
+                                  'Must be larger than 0']
+        Assert(dict(result.flatten())) == {'0': 5, '1': None, '2': 7,
+                                           '3': None}
+        Assert(numbers(raw, fail_fast=True).path) == (1,)
+        Assert(codegen.compile(numbers.schema)(raw).errors) == result.errors
+    Assert(numbers(array('i', range(10))).failures) == {}
+    # mixed values are validated one by one
+    Assert(numbers(['1', 2]).data) == [1, 2]
+
+    names = procrustes.List(procrustes.String(max_length=3)).compile()
+    result = names(['ann', u'', 'maria'])
+    Assert(result.data) == ['ann', None, None]
+    Assert(result.errors) == ['Must be longer than 1', 'Must be shorter than 3']
+    Assert(names.revalidate(result, {'2': 'bob'}).errors) == \
+        ['Must be longer than 1']
+    changed = names.revalidate(result, {'1': 'al', '2': 'bob', '3': ''})
+    Assert(type(changed)) == type(result)
+    Assert(changed.data) == ['ann', 'al', 'bob', None]
+    Assert(sorted(changed.failures)) == [3]
+    Assert(result.data) == ['ann', None, None]
+
+
+@p.test
+def lazy_validation():
+    checked = []
+
+    class Counted(procrustes.String):
+        def check_value(self, value):
+            checked.append(value)
+            return super(Counted, self).check_value(value)
+
+    class Form(forms.Declarative):
+        header = forms.String()
+        body = forms.List(forms.Dict({'text': Counted()}))
+
+    data = {'header': 'kuku', 'body': [{'text': 'a'}, {'text': ''}]}
+    form = Form(data, lazy=True)
+    Assert(form.pending) == True
+    Assert(form.header.data) == 'kuku'
+    Assert(checked) == []
+    Assert(form.body.pending) == True
+    Assert(form.errors) == ['Must be longer than 1']
+    Assert(checked) == ['a', '']
+
+    schema = procrustes.List(procrustes.Dict({'a': procrustes.Integer()}))
+    result = schema([{'a': 1}, 'x'], lazy=True)
+    Assert(result.force()).is_(result)
+    Assert(all(not child.pending for child in result.validated_data)) == True
+    Assert(result.data) == [{'a': 1}, None]
+    Assert(result.errors) == ['Value must be dict']
+    Assert(schema(5, lazy=True).error) == 'Must be iterable'
+    with Assert.raises(AttributeError):
+        form.missing
+
+
+@p.test
+def structured_errors():
+    schema = procrustes.Dict({'name': procrustes.String(max_length=3),
+                              'tags': procrustes.List(procrustes.Integer()),
+                              'pair': procrustes.Tuple(procrustes.Integer())})
+    data = {'name': 'long name', 'tags': [1, 'x'], 'pair': 5}
+    for result in (schema.compile()(data), codegen.compile(schema)(data),
+                   schema(data)):
+        Assert(sorted(result.errors)) == ['Must be iterable',
+                                          'Must be number, not a string',
+                                          'Must be shorter than 3']
+        Assert(all(isinstance(error, str) for error in result.errors)) == True
+    details = dict((error.path, error)
+                   for error in schema.compile()(data).details)
+    Assert(details[('name',)].code) == 'max_length'
+    Assert(details[('name',)].params) == (3,)
+    Assert(details[('tags', '1')].code) == 'type'
+    Assert(details[('pair',)].message) == 'Must be iterable'
+    # validators have paths too, without codes
+    Assert(sorted(error.path for error in schema(data).details)) == \
+        sorted(details)
+
+    error = errors.Error('max', 'Must be smaller than %i', (5,))
+    Assert(error.message) == 'Must be smaller than 5'
+    Assert(error) == 'Must be smaller than 5'
+    Assert(error.at(('a',)).path) == ('a',)
+    with Assert.raises(errors.ValidationError):
+        procrustes.Integer(max=5).check_value(7)
+    Assert(procrustes.Integer(max=5).inspect_value(7)[1]) == error
+
+    # overridden `inspect_value` is not skipped by checks of lists at once
+    class Upper(procrustes.String):
+        def inspect_value(self, value):
+            if value != value.upper():
+                return None, errors.Error('upper', 'Must be upper case')
+            return value, None
+
+    class Even(procrustes.Integer):
+        def inspect_value(self, value):
+            if value % 2:
+                return None, errors.Error('even', 'Must be even')
+            return value, None
+
+    for schema in (procrustes.List(Upper()), procrustes.List(Even())):
+        data = ['abc', 'DEF'] if isinstance(schema.type, Upper) else [1, 2]
+        for validate in (schema, schema.compile(), codegen.compile(schema)):
+            Assert(len(validate(data).errors)) == 1
+            Assert(validate(data).data[1]) == data[1]
+
+
+@p.test
+def json_stream():
+    schema = procrustes.Dict({'name': procrustes.String(max_length=5),
+                              'tags': procrustes.List(procrustes.String()),
+                              'pair': procrustes.Tuple(procrustes.Integer(),
+                                                       procrustes.String())})
+    decoder = jsonstream.JSONDecoder(schema, chunk_size=4)
+    source = ('{"junk": {"a": [1, {"b": "\\"}"}]}, "name": "ann",'
+              ' "tags": ["a", "b"], "pair": [1, "x"]}')
+    for data in (source, memoryview(source), StringIO(source)):
+        result = decoder.decode(data)
+        Assert(result.data) == {'name': 'ann', 'tags': ['a', 'b'],
+                                'pair': (1, 'x')}
+        Assert(result.errors) == []
+    Assert(decoder.decode(source).data) == schema.compile()(
+        json.loads(source)).data
+
+    # rest of stream is not read after first error
+    stream = StringIO('{"tags": ["a", 5, ' + '"b", ' * 1000 + '"c"]}')
+    result = decoder.decode(stream)
+    Assert(result.error) == 'Must be str or unicode instance'
+    Assert(result.path) == ('tags', 1)
+    Assert(stream.tell()) == 20
+    Assert(decoder.decode('{"pair": [1, "x", 2]}').error) == \
+        'Must be iterable of length 2'
+    Assert(decoder.decode('{"tags": "ab"}').error) == 'Must be iterable'
+    Assert(decoder.decode('{"x": [}').error) == "Invalid JSON: unexpected '}'"
+    Assert(decoder.decode(source + ' 1').error) == 'Invalid JSON: extra data'
+    # grammar of skipped values is checked
+    keys = jsonstream.JSONDecoder(procrustes.Dict({
+        'a': procrustes.Integer(required=False)}))
+    Assert(keys.decode('{"junk": {"x": [1, {}], "y": ""}, "a": 1}')
+           .data) == {'a': 1}
+    for source in ('{"junk": {"x", "y"}, "a": 1}', '{"x": 1: 2}',
+                   '{"x": 1, 2}', '{"junk": {"x": 1: 2}}',
+                   '{"junk": {"x": 1, 2}}', '{"junk": [1: 2]}'):
+        Assert(keys.decode(source).error).startswith('Invalid JSON: ')
+    # invalid token fails without reading the rest of stream
+    stream = StringIO('{"name": x' + ' ' * 1000 + '}')
+    Assert(decoder.decode(stream).error) == "Invalid JSON: unexpected 'x'"
+    Assert(stream.tell()) == 12
+    # long strings and escapes are split by chunks
+    tags = jsonstream.JSONDecoder(procrustes.List(procrustes.String()),
+                                  chunk_size=4)
+    name = 'a\\"b' * 1000
+    Assert(tags.decode(StringIO('["%s", "\\u00e9"]' % name)).data) == \
+        [json.loads('"%s"' % name), u'\xe9']
+
+
+@p.test
+def limits():
+    def items(item):
+        for number in count():
+            consumed.append(number)
+            yield item
+
+    limits = budgets.Limits(max_depth=2, max_nodes=10, max_string_bytes=8)
+    schema = procrustes.List(procrustes.List(procrustes.String()))
+    # root and two values of every item are counted
+    for validate in (schema.compile(), schema):
+        consumed = []
+        result = validate(items(['a']), limits=limits)
+        Assert(result.errors) == ['Must have at most 10 values']
+        Assert(len(consumed)) == 5
+    result = schema.compile()([['abcde'], [u'\xe9\xe9']], limits=limits)
+    Assert(result.details[0].code) == 'max_string_bytes'
+    Assert(result.path) == ('*', '*')
+    deep = procrustes.List(schema)
+    Assert(deep([[['a']]], limits=limits).errors) == \
+        ['Must be nested at most 2 levels deep']
+    Assert(deep.compile()([[['a']]], limits=limits).path) == ('*', '*')
+    Assert(schema([['a'], ['b']], limits=limits).errors) == []
+    # lazy data is validated within budget
+    strings = procrustes.List(procrustes.String())
+    small = budgets.Limits(max_string_bytes=3)
+    lazy = strings(['a' * 10, 'b'], lazy=True, limits=small)
+    Assert(lazy.pending) == False
+    Assert(lazy.errors) == ['Strings must have at most 3 bytes']
+    Assert(strings(['abc'], lazy=True, limits=small).data) == ['abc']
+
+    limited = procrustes.List(procrustes.Integer(), limits=limits)
+    Assert(limited.compile()(range(20)).errors) == \
+        ['Must have at most 10 values']
+    Assert(limited(range(20)).errors) == ['Must have at most 10 values']
+    Assert(limited.compile()(range(5)).data) == range(5)
+
+    schema = procrustes.List(procrustes.Integer(), max_length=3)
+    for validate in (schema.compile(), codegen.compile(schema), schema):
+        consumed = []
+        Assert(validate(items(1)).errors) == ['Must have at most 3 items']
+        Assert(len(consumed)) == 4
+        Assert(validate([1, 2, 3]).data) == [1, 2, 3]
+    decoder = jsonstream.JSONDecoder(procrustes.Dict({'a': schema}))
+    Assert(decoder.decode('{"a": [1, 2, 3, 4]}').path) == ('a',)
+    Assert(decoder.decode('{"x": [[[1]]], "a": []}', limits).details[0]
+           .code) == 'max_depth'
+    Assert(decoder.decode('{"x": "%s", "a": []}' % ('a' * 9), limits)
+           .details[0].code) == 'max_string_bytes'
+    # long string fails while it is scanned
+    stream = StringIO('{"x": "%s"}' % ('a' * 100000))
+    Assert(jsonstream.JSONDecoder(procrustes.Dict({}), chunk_size=4)
+           .decode(stream, limits).details[0].code) == 'max_string_bytes'
+    Assert(stream.tell()) == 16
+
+
+@p.test
+def partial_validation():
+    class Model(procrustes.Declarative):
+        name = procrustes.String()
+        age = procrustes.Integer(required=False)
+        tags = procrustes.List(procrustes.String())
+
+    plan = Model.compile()
+    document = plan({'name': 'ann', 'tags': ['a']})
+    for validate in (plan, codegen.compile(Model)):
+        patch = validate.validate_partial({'age': 5, 'unknown': 1})
+        Assert(patch.data) == {'age': 5}
+        Assert(patch.names) == ('age',)
+        merged = document.merge(patch)
+        Assert(merged.data) == {'name': 'ann', 'age': 5, 'tags': ['a']}
+        Assert(merged.names).is_(document.names)
+        Assert(document.data['age']) == None
+        failed = validate.validate_partial({'age': 'x'}, fail_fast=True)
+        Assert(failed.path) == ('age',)
+        Assert(validate.validate_partial({'age': 5}, ['name']).errors) == \
+            ['Must be str or unicode instance']
+    Assert(plan.validate_partial(5).errors) == ['Value must be dict']
+
+    instance = Model.validate_partial({'tags': ['b']})
+    Assert(instance.data) == {'tags': ['b']}
+    Assert(instance.validated_data.keys()) == ['tags']
+    Assert(Model.validate_partial({}, fields=['name']).errors) == \
+        ['Must be str or unicode instance']
+    Assert(Model.deepen_partial({'tags__0': 'a', 'tags__1': 'b'})) == \
+        {'tags': ['a', 'b']}
+    with Assert.raises(TypeError):
+        procrustes.List(procrustes.String()).compile().validate_partial([])
+
+
+@p.test
+def unions():
+    class Click(procrustes.Declarative):
+        x = procrustes.Integer()
+
+    class Key(procrustes.Declarative):
+        code = procrustes.String()
+
+    event = procrustes.Tagged('type', {'click': Click, 'key': Key})
+    for validate in (event, event.compile(), codegen.compile(event)):
+        result = validate({'type': 'click', 'x': '1', 'code': 5})
+        Assert(result.data) == {'type': 'click', 'x': 1}
+        Assert(sorted(result.flatten())) == [('type', 'click'), ('x', 1)]
+        Assert(validate({'type': 'key'}).errors) == \
+            ['Must be str or unicode instance']
+        Assert(validate({'type': 'move'}).errors) == \
+            ['Value of type must be one of: click, key']
+        Assert(validate({'type': []}).errors) == \
+            ['Value of type must be one of: click, key']
+    Assert(event.compile()({'type': 'move'}).details[0].code) == 'tag'
+    Assert(event.deepen({'type': 'key', 'code': 'a'})) == \
+        {'type': 'key', 'code': 'a'}
+
+    value = procrustes.Union(procrustes.Integer(),
+                             procrustes.List(procrustes.Integer()), Key)
+    for validate in (value, value.compile()):
+        Assert(validate('5').data) == 5
+        Assert(validate([1, '2']).data) == [1, 2]
+        Assert(validate({'code': 'a'}).data) == {'code': 'a'}
+        Assert(validate({'code': 1}).errors) == ['Must match one of 3 schemas']
+        Assert(sorted(validate([1, 2]).flatten())) == [('0', 1), ('1', 2)]
+    Assert(value.deepen({'0': '1', '1': '2'})) == ['1', '2']
+    Assert(value.deepen({'code': 'a'})) == {'code': 'a'}
+    Assert(value.deepen({'': '5'})) == '5'
+    # dicts are tried by dict types first
+    Assert(value.orders['dict']) == (2, 0, 1)
+
+    one = procrustes.OneOf(procrustes.Integer(), procrustes.String())
+    Assert(one(5).data) == 5
+    Assert(one('5').errors) == ['Must match exactly one of 2 schemas']
+    Assert(one.compile()('5').details[0].code) == 'one_of'
+
+    # absent values of optional unions
+    optional = procrustes.Dict({
+        'u': procrustes.Union(procrustes.Integer(), procrustes.String(),
+                              required=False),
+        't': procrustes.Tagged('type', {'key': Key}, required=False)})
+    for raw in (0, '', [], {}):
+        for validate in (optional, optional.compile()):
+            result = validate({'u': raw, 't': raw})
+            Assert(result.data) == {'u': raw, 't': raw}
+            Assert(result.errors) == []
+        Assert(dict(optional({'u': raw, 't': raw}).flatten())) == {}
+
+    # lazy union is validated on access and forces its chosen type
+    lazy = procrustes.Dict({'x': procrustes.Union(
+        procrustes.List(procrustes.List(procrustes.Integer())),
+        procrustes.Integer())})({'x': [[1]]}, lazy=True)
+    union = lazy.validated_data['x']
+    Assert(union.pending) == True
+    Assert(union.data) == [[1]]
+    Assert(union.validated_data.validated_data[0].pending) == False
+
+    # value is counted once, failed types are not counted
+    value = procrustes.Union(procrustes.Integer(), procrustes.String())
+    exact = budgets.Limits(max_nodes=1, max_string_bytes=5)
+    for validate in (value, value.compile()):
+        Assert(validate('abcde', limits=exact).errors) == []
+        Assert(validate('abcdef', limits=exact).errors) == \
+            ['Strings must have at most 5 bytes']
+    data = {'type': 'click', 'x': '1'}
+    # dict and its value, variant has no field for tag
+    exact = budgets.Limits(max_depth=1, max_nodes=2)
+    for validate in (Click, event, event.compile()):
+        Assert(validate(data, limits=exact).errors) == []
+        Assert(validate(data, limits=budgets.Limits(max_nodes=1)).errors) \
+            == ['Must have at most 1 values']
+
+    class Form(forms.Declarative):
+        event = forms.Tagged('type', {
+            'click': forms.Dict({'x': forms.Integer()}),
+            'key': forms.Dict({'code': forms.String()})})
+        value = forms.Union(forms.Integer(), forms.String())
+
+    form = Form({'event': {'type': 'key', 'code': 'a'}, 'value': 'b'})
+    Assert([(widget.name, widget.data) for widget in form.widgets()]) == \
+        [('form__event__type', 'key'), ('form__event__code', 'a'),
+         ('form__value', 'b')]
+    Assert([widget.name for widget in Form(None, False).widgets()]) == \
+        ['form__event__type', 'form__event__x', 'form__value']
+    flat = {'form__event__type': 'click', 'form__event__x': '3',
+            'form__value': '4'}
+    Assert(Form(None, False).unflat(flat)) == \
+        {'event': {'type': 'click', 'x': '3'}, 'value': '4'}
+    markup = render.Renderer(Form).render(form)
+    Assert('value="key"' in markup and 'form__event__code' in markup) == True
+
+    # hooks and memoized checks of types
+    calls = []
+
+    def small(values):
+        calls.append(values)
+        return [None if value < 10 else 'Too big' for value in values]
+
+    value = procrustes.Dict({'x': procrustes.Union(
+        procrustes.Integer(hooks=[small]), procrustes.String())})
+    Assert(value.avalidate({'x': 50}).get(5).errors) == ['Too big']
+    Assert(value.avalidate({'x': 'a'}).get(5).errors) == []
+    event = procrustes.Tagged('type', {'key': procrustes.Dict(
+        {'code': procrustes.Integer(hooks=[small])})})
+    Assert(event.avalidate({'type': 'key', 'code': 20}).get(5).errors) == \
+        ['Too big']
+    Assert(calls) == [[50], [20]]
+    # indexes of types, chosen by nested unions, are kept for hooks
+    nested = procrustes.Union(procrustes.List(procrustes.String()),
+                              procrustes.Union(procrustes.Dict(
+                                  {'a': procrustes.Integer()}),
+                                  procrustes.Integer(hooks=[small])))
+    Assert(nested.compile()(50).chosen) == (1, 1)
+    Assert(nested(50).chosen) == (1, 1)
+    Assert(nested({'a': 1}).chosen) == (1, 0)
+    Assert(nested.avalidate(50).get(5).errors) == ['Too big']
+    Assert(calls[-1]) == [50]
+    cache = procrustes.memoize(procrustes.List(value))
+    Assert(value.named_types['x'].types[1].memo).is_(cache)
+    Assert(procrustes.memoize(event, cache)).is_(
+        event.variants['key'].named_types['code'].memo)
+
+    # chosen type is rendered, though it is not first of its kind
+    Form = forms.Dict({'x': forms.Union(forms.Dict({'a': forms.Integer()}),
+                                        forms.Dict({'b': forms.String()}))})
+    renderer = render.Renderer(Form)
+    for value in (Form({'x': {'b': 'hello'}}),
+                  Form.compile()({'x': {'b': 'hello'}})):
+        markup = renderer.render(value)
+        Assert('form__x__b' in markup and 'hello' in markup) == True
+        Assert('form__x__a' in markup) == False
+
+
+@p.test
+def serializer():
+    class Record(procrustes.Declarative):
+        name = procrustes.String()
+        age = procrustes.Integer(required=False)
+        tags = procrustes.List(procrustes.String())
+        pair = procrustes.Tuple(procrustes.Boolean(),
+                                procrustes.Dict({'a': procrustes.Integer()}))
+        value = procrustes.Union(procrustes.Integer(),
+                                 procrustes.List(procrustes.Integer()))
+
+    dumps = serialize.Serializer(Record)
+    values = [{'name': u'\xe9"', 'tags': ['a', 'b'], 'pair': [1, {'a': 2}],
+               'value': ['3']},
+              {'name': 1, 'tags': [2, 'b'], 'pair': 5, 'value': 'x'},
+              None]
+    for validate in (Record, Record.compile(), codegen.compile(Record)):
+        for value in values:
+            result = validate(value)
+            Assert(json.loads(dumps.dumps(result))) == \
+                json.loads(json.dumps(result.data))
+            Assert(dumps.flatten(result)) == dict(result.flatten())
+    result = Record.compile()(values[0])
+    Assert(dumps.dumps(result).startswith('{')) == True
+    Assert(dumps.flatten(result)['tags__1']) == 'b'
+    # sparse results are written by their data
+    patch = Record.compile().validate_partial({'age': '5'})
+    Assert(json.loads(dumps.dumps(patch))) == {'age': 5}
+    Assert(dumps.flatten(patch)) == {'age': 5}
+    stream = StringIO()
+    numbers = procrustes.List(procrustes.Integer())
+    serialize.Serializer(numbers).dump(numbers.compile()(range(3)), stream)
+    Assert(stream.getvalue()) == '[0,1,2]'
+
+    # values of own checks of subclasses are encoded by json
+    class Number(procrustes.String):
+        def inspect_value(self, value):
+            return float(value), None
+
+    numbers = procrustes.List(Number())
+    result = numbers.compile()(['1.5', '2'])
+    Assert(serialize.Serializer(numbers).dumps(result)) == '[1.5,2.0]'
 
 
 if __name__ == '__main__':